@@ -8,6 +8,7 @@ sys.path.insert(0, workspace_root + "/../../")
 
 # import this repo's classes
 import pyanalib.pandas_helpers as ph
+import pyanalib.split_df_helpers as splh
 from makedf.util import *
 
 import kinematics
@@ -15,12 +16,11 @@ import kinematics
 def load_data(file, nfiles=1):
     """Load event, header, and mcnu data from HDF file."""
 
-    for s in range(nfiles):
+    evt_dfs, hdr_dfs, stub_dfs = [], [], []
+    for s, split in enumerate(splh.iter_splits(file, ["evt", "hdr", "mcnu", "stub"], n_max=nfiles)):
         print("df index:"+str(s))
-        df_evt = pd.read_hdf(file, "evt_"+str(s))
-        df_hdr = pd.read_hdf(file, "hdr_"+str(s))
-        df_mcnu = pd.read_hdf(file, "mcnu_"+str(s))
-        df_stub = pd.read_hdf(file, "stub_"+str(s))
+        df_evt = split["evt"]
+        df_mcnu = split["mcnu"]
 
         matchdf = df_evt.copy()
         matchdf.columns = pd.MultiIndex.from_tuples([(col, '') for col in matchdf.columns])
@@ -36,20 +36,15 @@ def load_data(file, nfiles=1):
         df_evt.drop(columns=cols_to_drop, inplace=True)
         del df_mcnu
 
-        if s == 0:
-            res_df_evt = df_evt
-            res_df_hdr = df_hdr
-            res_df_stub = df_stub
-        else:
-            res_df_evt = pd.concat([res_df_evt, df_evt])
-            res_df_hdr = pd.concat([res_df_hdr, df_hdr])
-            res_df_stub = pd.concat([res_df_stub, df_stub])
+        evt_dfs.append(df_evt)
+        hdr_dfs.append(split["hdr"])
+        stub_dfs.append(split["stub"])
 
         del df_evt
-        del df_hdr
-        del df_stub
+        del split
 
-    return res_df_evt, res_df_hdr, res_df_stub
+    # concatenate once at the end instead of re-copying the growing frames every split
+    return pd.concat(evt_dfs), pd.concat(hdr_dfs), pd.concat(stub_dfs)
 
 def scale_pot(df, df_hdr, desired_pot):
     """Scale DataFrame by desired POT."""
@@ -46,17 +46,11 @@ def make_pandora_no_cuts_df(f):
         dedx_smear = chi2pid.dedx(trkhitdf, gain="ICARUS", calibrate="ICARUS", smear=0.05)
         trkhitdf["dedx_smear"] = dedx_smear
 
-        trkdf["chi2u"] = chi2pid.chi2u(trkhitdf, dedxname="dedx_redo")[0]
-        trkdf["chi2p"] = chi2pid.chi2p(trkhitdf, dedxname="dedx_redo")[0]
-
-        trkdf["chi2u_lo"] = chi2pid.chi2u(trkhitdf, dedxname="dedx_lo")[0]
-        trkdf["chi2p_lo"] = chi2pid.chi2p(trkhitdf, dedxname="dedx_lo")[0]
-
-        trkdf["chi2u_hi"] = chi2pid.chi2u(trkhitdf, dedxname="dedx_hi")[0]
-        trkdf["chi2p_hi"] = chi2pid.chi2p(trkhitdf, dedxname="dedx_hi")[0]
-
-        trkdf["chi2u_smear"] = chi2pid.chi2u(trkhitdf, dedxname="dedx_smear")[0]
-        trkdf["chi2p_smear"] = chi2pid.chi2p(trkhitdf, dedxname="dedx_smear")[0]
+        # every hypothesis and dE/dx variation in one pass over the hits
+        chi2s = chi2pid.chi2_batch(trkhitdf, ["dedx_redo", "dedx_lo", "dedx_hi", "dedx_smear"], ["muon", "proton"])
+        for dedxname, suffix in [("dedx_redo", ""), ("dedx_lo", "_lo"), ("dedx_hi", "_hi"), ("dedx_smear", "_smear")]:
+            trkdf["chi2u" + suffix] = chi2s[(dedxname, "muon", "chi2")]
+            trkdf["chi2p" + suffix] = chi2s[(dedxname, "proton", "chi2")]
     else:
         trkdf["chi2u"] = trkdf.pfp.trk.chi2pid.I2.chi2_muon
         trkdf["chi2p"] = trkdf.pfp.trk.chi2pid.I2.chi2_proton
@@ -82,8 +76,8 @@ def make_pandora_no_cuts_df(f):
     # mu candidate is track pfp with smallest chi2_mu/chi2_p
     mudf = trkdf[(trkdf.pfp.trackScore> 0.0)].sort_values(trkdf.pfp.index.names[:-1] + [("pfp", "trk", "chi2pid","I2","mu_over_p", "")]).groupby(level=[0, 1]).head(1)
     # mudf = trkdf[(trkdf.pfp.trackScore> 0.0)].sort_values(trkdf.pfp.index.names[:-1] + [("pfp", "trk", "chi2pid","I2","mu_over_p", "")]).groupby(level=[0, 1]).head(1)
-    mudf.columns = pd.MultiIndex.from_tuples([tuple(["mu"] + list(c)) for c in mudf.columns])
-    slcdf = multicol_merge(slcdf, mudf.droplevel(-1), left_index=True, right_index=True, how="left", validate="one_to_one")
+    slcdf = MultiColBuilder(slcdf)
+    slcdf.add_frame(mudf.droplevel(-1), "mu")
     idx_mu = mudf.index
 
     # p candidate is track pfp with largest chi2_mu/chi2_p of remaining pfps
@@ -91,8 +85,7 @@ def make_pandora_no_cuts_df(f):
     idx_not_mu = idx_pfps.difference(idx_mu)
     notmudf = trkdf.loc[idx_not_mu]
     pdf = notmudf[(notmudf.pfp.trackScore > 0.0)].sort_values(notmudf.pfp.index.names[:-1] + [("pfp", "trk", "chi2pid", "I2", "mu_over_p", "")]).groupby(level=[0,1]).tail(1)
-    pdf.columns = pd.MultiIndex.from_tuples([tuple(["p"] + list(c)) for c in pdf.columns])
-    slcdf = multicol_merge(slcdf, pdf.droplevel(-1), left_index=True, right_index=True, how="left", validate="one_to_one")
+    slcdf.add_frame(pdf.droplevel(-1), "p")
     idx_p = pdf.index
 
     # note if there are any other track/showers
@@ -101,11 +94,12 @@ def make_pandora_no_cuts_df(f):
     # longest other shower
     othershwdf = otherdf[otherdf.pfp.trackScore < 0.5]
     other_shw_length = othershwdf.pfp.trk.len.groupby(level=[0,1]).max().rename("other_shw_length")
-    slcdf = multicol_add(slcdf, other_shw_length)
+    slcdf.add(other_shw_length)
     # longest other track
     othertrkdf = otherdf[otherdf.pfp.trackScore > 0.5]
     other_trk_length = othertrkdf.pfp.trk.len.groupby(level=[0,1]).max().rename("other_trk_length")
-    slcdf = multicol_add(slcdf, other_trk_length)
+    slcdf.add(other_trk_length)
+    slcdf = slcdf.build()
 
     if slcdf.empty:
         print("found empty slice!")
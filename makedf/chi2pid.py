@@ -1,8 +1,12 @@
 from . import calo
+import os
 import pandas as pd
 import numpy as np
 import sqlite3
+import tempfile
+import zipfile
 import uproot
+from pyanalib.segment_helpers import segment_codes
 
 larsoft_data_v = "v1_02_02"
 icarus_data_v = "v10_06_00"
@@ -33,25 +37,83 @@ SBND_CALO_PARAMS = {
 }
 
 
-def chi2(hitdf, exprr, expdedx, experr, dedxname="dedx"):
-    dedx_exp = pd.cut(hitdf.rr, exprr, labels=expdedx).astype(float)
-    dedx_err = pd.cut(hitdf.rr, exprr, labels=experr).astype(float)
+def _track_codes(hitdf):
+    # track of each hit (every index level but the last), as codes into the sorted tracks
+    return segment_codes(hitdf.index, list(range(hitdf.index.nlevels-1)))
 
-    dedx_res = (0.04231 + 0.0001783*hitdf[dedxname]**2)*hitdf[dedxname]
+def _rr_bins(rr, exprr):
+    # template bin of each hit, matching pd.cut's right-closed bins, -1 outside the template
+    bins = np.searchsorted(exprr, rr, side="left") - 1
+    bins[bins >= len(exprr) - 1] = -1
+    return bins
 
-    v_chi2 = (hitdf[dedxname] - dedx_exp)**2 / (dedx_err**2 + dedx_res**2)
+def _chi2_mask(hitdf, dedx):
+    return (hitdf.rr.values < rr_max_cut_chi2) & ~hitdf.firsthit.values.astype(bool) & ~hitdf.lasthit.values.astype(bool) & (dedx < 1000.)
 
-    when_chi2 = (hitdf.rr < rr_max_cut_chi2) & ~hitdf.firsthit & ~hitdf.lasthit & (hitdf[dedxname] < 1000.)
+def _chi2_sums(codes, ntrack, dedx, bins, expdedx, experr):
+    # per track sum of the hit chi2s (hits outside the template count as 0) and number of hits
+    inside = bins >= 0
+    ibin = np.where(inside, bins, 0)
+    dedx_exp = np.where(inside, expdedx[ibin], np.nan)
+    dedx_err = np.where(inside, experr[ibin], np.nan)
 
-    chi2_group = v_chi2[when_chi2].groupby(level=list(range(hitdf.index.nlevels-1)))
+    dedx_res = (0.04231 + 0.0001783*dedx**2)*dedx
 
-    return chi2_group.sum() / chi2_group.size(), chi2_group.size()
+    v_chi2 = (dedx - dedx_exp)**2 / (dedx_err**2 + dedx_res**2)
+
+    chi2sum = np.bincount(codes, weights=np.where(np.isnan(v_chi2), 0., v_chi2), minlength=ntrack)
+    return chi2sum, np.bincount(codes, minlength=ntrack)
+
+def chi2(hitdf, exprr, expdedx, experr, dedxname="dedx"):
+    codes, tracks = _track_codes(hitdf)
+    dedx = hitdf[dedxname].values
+    when_chi2 = _chi2_mask(hitdf, dedx)
+
+    chi2sum, ndof = _chi2_sums(codes[when_chi2], len(tracks), dedx[when_chi2], _rr_bins(hitdf.rr.values[when_chi2], exprr), expdedx, experr)
+
+    # tracks without any selected hit are left out
+    has_hits = ndof > 0
+    return pd.Series(chi2sum[has_hits] / ndof[has_hits], index=tracks[has_hits]), pd.Series(ndof[has_hits], index=tracks[has_hits])
+
+def chi2_batch(hitdf, dedxnames=("dedx",), pars=("muon", "proton")):
+    """chi2 and ndof of every (dE/dx column, particle hypothesis) pair in one pass.
+
+    The hit selection and per-hit chi2 are the same as in chi2. Template bins and
+    the hits' tracks are found once, and each pair is one bincount over the tracks.
+    Returns a frame indexed by track with columns (dedxname, par, "chi2"/"ndof");
+    a track without selected hits for a dE/dx column gets NaN there, as it would
+    when assigning the output of chi2.
+    """
+    t = _load("templates")
+    templates = {
+        "muon": (t["muon_rr"], t["muon_dedx"], t["muon_yerr"]),
+        "proton": (t["proton_rr"], t["proton_dedx"], t["proton_yerr"]),
+    }
+    codes, tracks = _track_codes(hitdf)
+    rr = hitdf.rr.values
+    bins = {par: _rr_bins(rr, templates[par][0]) for par in pars}
+
+    out = {}
+    for name in dedxnames:
+        dedx = hitdf[name].values
+        when_chi2 = _chi2_mask(hitdf, dedx)
+        for par in pars:
+            _, expdedx, experr = templates[par]
+            chi2sum, ndof = _chi2_sums(codes[when_chi2], len(tracks), dedx[when_chi2], bins[par][when_chi2], expdedx, experr)
+            has_hits = ndof > 0
+            out[(name, par, "chi2")] = np.where(has_hits, chi2sum / np.maximum(ndof, 1), np.nan)
+            out[(name, par, "ndof")] = np.where(has_hits, ndof, np.nan)
+
+    df = pd.DataFrame(out, index=tracks)
+    return df[df.xs("ndof", axis=1, level=2).notna().any(axis=1).values]
 
 def chi2u(hitdf, dedxname="dedx"):
-    return chi2(hitdf, muon_rr, muon_dedx, muon_yerr, dedxname)
+    t = _load("templates")
+    return chi2(hitdf, t["muon_rr"], t["muon_dedx"], t["muon_yerr"], dedxname)
 
 def chi2p(hitdf, dedxname="dedx"):
-    return chi2(hitdf, proton_rr, proton_dedx, proton_yerr, dedxname)
+    t = _load("templates")
+    return chi2(hitdf, t["proton_rr"], t["proton_dedx"], t["proton_yerr"], dedxname)
 
 def chi2par(hitdf, dedxname="dedx", par=""):
     if par == "muon":
@@ -69,6 +131,8 @@ def chi2_ndof(hitdf):
 
 def dqdx(dqdxdf, gain=None, calibrate=None, isMC=False):
     if calibrate == "ICARUS": 
+        cal = _load("icarus")
+
         # get raw dqdx
         dqdx = dqdxdf.integral / dqdxdf.pitch
 
@@ -79,25 +143,19 @@ def dqdx(dqdxdf, gain=None, calibrate=None, isMC=False):
         itpc = dqdxdf.tpc // 2 + dqdxdf.cryo*2
         plane = dqdxdf.plane
 
-        yzdf = pd.DataFrame({"ybin": ybin, "zbin": zbin, "itpc": itpc, "plane": plane, "iov": iov})
-        yz_scale = yzdf.merge(IC_yz_cal_df, on=["iov", "itpc", "plane", "ybin", "zbin"], how="left", validate="many_to_one").scale
+        yz_scale = pd.Series(cal["IC_yz_cal"](iov, itpc, plane, ybin, zbin), index=dqdxdf.index)
         yz_scale[yz_scale == -999.000000] = 1.
         yz_scale = np.clip(yz_scale, 0.7, 1.3).fillna(1)
-        yz_scale.index = dqdxdf.index
 
         # compute lifetime correction
         iov = _etau_iov(dqdxdf.run)
-        etaudf = pd.DataFrame({"itpc": itpc, "iov": iov})
-        etau = etaudf.merge(IC_etau_cal_df, on=["iov", "itpc"], how="left", validate="many_to_one").etau
+        etau = pd.Series(cal["IC_etau_cal"](iov, itpc), index=dqdxdf.index)
         etau = etau.fillna(np.inf)
-        etau.index = dqdxdf.index
         etau[dqdxdf.run == 1] = 3.5e3 # set MC lifetime to MC default
 
         # compute TPC scale
         iov = _tpc_iov(dqdxdf.run)
-        tpcdf = pd.DataFrame({"itpc": itpc, "plane": plane, "iov": iov})
-        tpc_scale = tpcdf.merge(IC_tpc_cal_df, on=["iov", "itpc", "plane"], how="left", validate="many_to_one").scale
-        tpc_scale.index = dqdxdf.index
+        tpc_scale = pd.Series(cal["IC_tpc_cal"](iov, itpc, plane), index=dqdxdf.index)
 
         # apply the corrections
         t0 = 0 # assume in time
@@ -107,13 +165,15 @@ def dqdx(dqdxdf, gain=None, calibrate=None, isMC=False):
 
         dqdx = dqdx * tpc_scale * np.exp(tdrift / etau) / yz_scale
     elif calibrate == "SBND": # TODO: add calibrations?
+        cal = _load("sbnd")
+
         # get raw dqdx
         dqdx  = dqdxdf.integral / dqdxdf.pitch
 
-        this_yz_cal_df = SBND_yz_cal_mc_df   if isMC else SBND_yz_cal_data_df
-        this_yz_zbin = yz_zbin_sbnd_mc if isMC else yz_zbin_sbnd_data
-        this_yz_ybin = yz_ybin_sbnd_mc if isMC else yz_ybin_sbnd_data
-        this_etau_df   = SBND_etau_cal_mc_df if isMC else SBND_etau_cal_data_df
+        this_yz_cal = cal["SBND_yz_cal_mc"]   if isMC else cal["SBND_yz_cal_data"]
+        this_yz_zbin = cal["yz_zbin_sbnd_mc"] if isMC else cal["yz_zbin_sbnd_data"]
+        this_yz_ybin = cal["yz_ybin_sbnd_mc"] if isMC else cal["yz_ybin_sbnd_data"]
+        this_etau_cal  = cal["SBND_etau_cal_mc"] if isMC else cal["SBND_etau_cal_data"]
 
         # compute y-scale
         ybin = _yz_ybin(dqdxdf.y, this_yz_ybin)
@@ -124,21 +184,17 @@ def dqdx(dqdxdf, gain=None, calibrate=None, isMC=False):
         itpc = dqdxdf.tpc
         plane = dqdxdf.plane
 
-        yzdf = pd.DataFrame({"ybin": ybin, "zbin": zbin, "itpc": itpc, "plane": plane, "iov": iov})
-        yz_scale = yzdf.merge(this_yz_cal_df, on=["iov", "itpc", "plane", "ybin", "zbin"], how="left", validate="many_to_one").scale
+        yz_scale = pd.Series(this_yz_cal(iov, itpc, plane, ybin, zbin), index=dqdxdf.index)
         yz_scale[yz_scale < 1e-6] = 1.
         yz_scale = yz_scale.fillna(1)
-        yz_scale.index = dqdxdf.index
 
         #yzdf['rr'] = dqdxdf.rr
         #yzdf['scale'] = yz_scale
         #print(yzdf[yzdf.rr < 26.].head(50))
         # compute lifetime correction
         iov = dqdxdf.iov ## FIXME: once SBND has time dep. calo, it should be updated
-        etaudf = pd.DataFrame({"itpc": itpc, "iov": iov})
-        etau = etaudf.merge(this_etau_df, on=["iov", "itpc"], how="left", validate="many_to_one").etau
+        etau = pd.Series(this_etau_cal(iov, itpc), index=dqdxdf.index)
         etau = etau.fillna(np.inf)
-        etau.index = dqdxdf.index
 
         # apply the corrections
         t0 = 0 # assume in time
@@ -194,21 +250,50 @@ def _yz_zbin(z, yz_zbin):
     return np.searchsorted(yz_zbin, z) - 1
 
 def _yz_iov(run): 
-    iov = __iov(run, IC_yz_cal_iovdf)
+    iov = __iov(run, _load("icarus")["IC_yz_cal_iovdf"])
     iov[run == 1] = 4 # MC default to Run 4
     return iov
 
 def _etau_iov(run):
-    iov = __iov(run, IC_etau_cal_iovdf)
+    iov = __iov(run, _load("icarus")["IC_etau_cal_iovdf"])
     iov[run == 1] = -1 # MC default to no run
     return iov
 
 def _tpc_iov(run):
-    iov = __iov(run, IC_tpc_cal_iovdf)
+    iov = __iov(run, _load("icarus")["IC_tpc_cal_iovdf"])
     iov[run == 1] = 3 # MC default to Run 4
     return iov
     
 
+class CalibrationTable(object):
+    """Dense array version of a calibration table, with one axis per key column.
+
+    A lookup is a searchsorted of each key into that key's values plus one gather,
+    instead of a merge. Keys that are not in the table give NaN, like the left
+    merge did, and duplicated keys are rejected like validate="many_to_one".
+    """
+    def __init__(self, df, keys, value):
+        self.levels = [np.unique(df[k].values) for k in keys]
+        shape = tuple(len(l) for l in self.levels)
+        codes = [np.searchsorted(l, df[k].values) for l, k in zip(self.levels, keys)]
+        flat = np.ravel_multi_index(codes, shape)
+        if len(np.unique(flat)) != len(flat):
+            raise ValueError("Calibration table has duplicated keys: %s" % keys)
+        self.table = np.full(shape, np.nan)
+        self.table.flat[flat] = df[value].values
+
+    def __call__(self, *keys):
+        if self.table.size == 0:
+            return np.full(len(keys[0]), np.nan)
+        idx = []
+        found = True
+        for levels, k in zip(self.levels, keys):
+            k = np.asarray(k)
+            i = np.minimum(np.searchsorted(levels, k), len(levels) - 1)
+            found = found & (levels[i] == k)
+            idx.append(i)
+        return np.where(found, self.table[tuple(idx)], np.nan)
+
 def __iov(run, df):
     return pd.cut(run, list(df.run) + [np.inf], labels=df.iov).astype(float).fillna(-1).astype(int)
 
@@ -218,22 +303,29 @@ def __iov(run, df):
 datadir = "/cvmfs/larsoft.opensciencegrid.org/products/larsoft_data/" + larsoft_data_v + "/ParticleIdentification/"
 fhist = datadir + "dEdxrestemplates.root"
 
-profp = uproot.open(fhist)["dedx_range_pro"]
-profmu = uproot.open(fhist)["dedx_range_mu"]
-
-proton_dedx = profp.values()
-proton_rr = profp.axis().edges()
-proton_yerr = profp.errors(error_mode="s")
-for i in range(len(proton_yerr)):
-    if proton_yerr[i] < 1e-6:
-        proton_yerr[i] = (proton_yerr[i-1] + proton_yerr[i+1]) / 2
-    if proton_dedx[i] < 1e-6:
-        proton_dedx[i] = (proton_dedx[i-1] + proton_dedx[i+1]) / 2
-
-muon_dedx = profmu.values()
-muon_rr = profmu.axis().edges()
-muon_rr_center = profmu.axis().centers()
-muon_yerr = profmu.errors(error_mode="s")
+def _read_templates():
+    with uproot.open(fhist) as f:
+        profp = f["dedx_range_pro"]
+        profmu = f["dedx_range_mu"]
+
+    proton_dedx = profp.values()
+    proton_rr = profp.axis().edges()
+    proton_yerr = profp.errors(error_mode="s")
+    for i in range(len(proton_yerr)):
+        if proton_yerr[i] < 1e-6:
+            proton_yerr[i] = (proton_yerr[i-1] + proton_yerr[i+1]) / 2
+        if proton_dedx[i] < 1e-6:
+            proton_dedx[i] = (proton_dedx[i-1] + proton_dedx[i+1]) / 2
+
+    return {
+        "proton_dedx": proton_dedx,
+        "proton_rr": proton_rr,
+        "proton_yerr": proton_yerr,
+        "muon_dedx": profmu.values(),
+        "muon_rr": profmu.axis().edges(),
+        "muon_rr_center": profmu.axis().centers(),
+        "muon_yerr": profmu.errors(error_mode="s"),
+    }
 
 ##############################
 # ICARUS TPC calo files
@@ -251,7 +343,7 @@ IC_tpc_cal_f = "/cvmfs/icarus.opensciencegrid.org/products/icarus/icarus_data/"
 IC_tpc_cal_db = "tpc_dqdxcalibration_allplanes_data_data"
 IC_tpc_cal_iov = "tpc_dqdxcalibration_allplanes_data_iovs"
 
-# LOAD THE YZ CALIBRATION
+# YZ CALIBRATION BINNING
 yz_ybin = np.linspace(-180, 130, 32)
 yz_ylos = yz_ybin[:-1]
 yz_yhis = yz_ybin[1:]
@@ -262,89 +354,89 @@ yz_zlos = yz_zbin[:-1]
 yz_zhis = yz_zbin[1:]
 yz_zs = (yz_zlos + yz_zhis) / 2.
 
-conn = sqlite3.connect(IC_yz_cal_f)
-cursor = conn.cursor()
-cursor.execute("SELECT * FROM %s" % IC_yz_cal_db)
-rows = cursor.fetchall()
-data = list(zip(*rows))
-IC_yz_cal_df = pd.DataFrame({
-  "iov": data[0],
-  "plane": data[2],
-  "tpc": data[3],
-  "ybin": data[4],
-  "zbin": data[5],
-  "scale": data[6]
-})
-IC_yz_cal_df["itpc"] = 0 
-IC_yz_cal_df.loc[IC_yz_cal_df.tpc == "EE", "itpc"] = 0
-IC_yz_cal_df.loc[IC_yz_cal_df.tpc == "EW", "itpc"] = 1
-IC_yz_cal_df.loc[IC_yz_cal_df.tpc == "WE", "itpc"] = 2
-IC_yz_cal_df.loc[IC_yz_cal_df.tpc == "WW", "itpc"] = 3
-del IC_yz_cal_df["tpc"]
-
-cursor.execute("SELECT * FROM %s WHERE ACTIVE=1" % IC_yz_cal_iov)
-rows = cursor.fetchall()
-data = list(zip(*rows))
-IC_yz_cal_iovdf = pd.DataFrame({
-  "iov": data[0],
-  "begin_time": data[1],
-})
-IC_yz_cal_iovdf["run"] = IC_yz_cal_iovdf.begin_time % 1000000000
-IC_yz_cal_iovdf.sort_values(by="run", inplace=True)
-conn.close()
-
-# LOAD THE LIFETIME CALIBRATION
-conn = sqlite3.connect(IC_etau_cal_f)
-cursor = conn.cursor()
-cursor.execute("SELECT * FROM %s" % IC_etau_cal_db)
-rows = cursor.fetchall()
-data = list(zip(*rows))
-IC_etau_cal_df = pd.DataFrame({
-  "iov": data[0],
-  "itpc": data[1],
-  "etau": data[2]
-})
-
-cursor.execute("SELECT * FROM %s WHERE ACTIVE=1" % IC_etau_cal_iov)
-rows = cursor.fetchall()
-data = list(zip(*rows))
-IC_etau_cal_iovdf = pd.DataFrame({
-  "iov": data[0],
-  "begin_time": data[1],
-})
-IC_etau_cal_iovdf["run"] = IC_etau_cal_iovdf.begin_time % 1000000000
-IC_etau_cal_iovdf.sort_values(by="run", inplace=True)
-conn.close()
-
-# LOAD THE TPC SCALE
-conn = sqlite3.connect(IC_tpc_cal_f)
-cursor = conn.cursor()
-cursor.execute("SELECT * FROM %s" % IC_tpc_cal_db)
-rows = cursor.fetchall()
-data = list(zip(*rows))
-IC_tpc_cal_df = pd.DataFrame({
-  "iov": data[0],
-  "plane": data[2],
-  "tpc": data[3],
-  "scale": data[4]
-})
-IC_tpc_cal_df["itpc"] = 0 
-IC_tpc_cal_df.loc[IC_tpc_cal_df.tpc == "EE", "itpc"] = 0
-IC_tpc_cal_df.loc[IC_tpc_cal_df.tpc == "EW", "itpc"] = 1
-IC_tpc_cal_df.loc[IC_tpc_cal_df.tpc == "WE", "itpc"] = 2
-IC_tpc_cal_df.loc[IC_tpc_cal_df.tpc == "WW", "itpc"] = 3
-del IC_tpc_cal_df["tpc"]
-
-cursor.execute("SELECT * FROM %s WHERE ACTIVE=1" % IC_tpc_cal_iov)
-rows = cursor.fetchall()
-data = list(zip(*rows))
-IC_tpc_cal_iovdf = pd.DataFrame({
-  "iov": data[0],
-  "begin_time": data[1],
-})
-IC_tpc_cal_iovdf["run"] = IC_tpc_cal_iovdf.begin_time % 1000000000
-IC_tpc_cal_iovdf.sort_values(by="run", inplace=True)
-conn.close()
+def _read_ic_iovs(cursor, iov_table):
+    cursor.execute("SELECT * FROM %s WHERE ACTIVE=1" % iov_table)
+    rows = cursor.fetchall()
+    data = list(zip(*rows))
+    iovdf = pd.DataFrame({
+      "iov": data[0],
+      "begin_time": data[1],
+    })
+    iovdf["run"] = iovdf.begin_time % 1000000000
+    iovdf.sort_values(by="run", inplace=True)
+    return iovdf
+
+def _ic_itpc(df):
+    df["itpc"] = 0 
+    df.loc[df.tpc == "EE", "itpc"] = 0
+    df.loc[df.tpc == "EW", "itpc"] = 1
+    df.loc[df.tpc == "WE", "itpc"] = 2
+    df.loc[df.tpc == "WW", "itpc"] = 3
+    del df["tpc"]
+    return df
+
+def _read_icarus():
+    # LOAD THE YZ CALIBRATION
+    conn = sqlite3.connect(IC_yz_cal_f)
+    cursor = conn.cursor()
+    cursor.execute("SELECT * FROM %s" % IC_yz_cal_db)
+    rows = cursor.fetchall()
+    data = list(zip(*rows))
+    IC_yz_cal_df = _ic_itpc(pd.DataFrame({
+      "iov": data[0],
+      "plane": data[2],
+      "tpc": data[3],
+      "ybin": data[4],
+      "zbin": data[5],
+      "scale": data[6]
+    }))
+    IC_yz_cal_iovdf = _read_ic_iovs(cursor, IC_yz_cal_iov)
+    conn.close()
+
+    # LOAD THE LIFETIME CALIBRATION
+    conn = sqlite3.connect(IC_etau_cal_f)
+    cursor = conn.cursor()
+    cursor.execute("SELECT * FROM %s" % IC_etau_cal_db)
+    rows = cursor.fetchall()
+    data = list(zip(*rows))
+    IC_etau_cal_df = pd.DataFrame({
+      "iov": data[0],
+      "itpc": data[1],
+      "etau": data[2]
+    })
+    IC_etau_cal_iovdf = _read_ic_iovs(cursor, IC_etau_cal_iov)
+    conn.close()
+
+    # LOAD THE TPC SCALE
+    conn = sqlite3.connect(IC_tpc_cal_f)
+    cursor = conn.cursor()
+    cursor.execute("SELECT * FROM %s" % IC_tpc_cal_db)
+    rows = cursor.fetchall()
+    data = list(zip(*rows))
+    IC_tpc_cal_df = _ic_itpc(pd.DataFrame({
+      "iov": data[0],
+      "plane": data[2],
+      "tpc": data[3],
+      "scale": data[4]
+    }))
+    IC_tpc_cal_iovdf = _read_ic_iovs(cursor, IC_tpc_cal_iov)
+    conn.close()
+
+    return {
+        "IC_yz_cal_df": IC_yz_cal_df,
+        "IC_yz_cal_iovdf": IC_yz_cal_iovdf,
+        "IC_etau_cal_df": IC_etau_cal_df,
+        "IC_etau_cal_iovdf": IC_etau_cal_iovdf,
+        "IC_tpc_cal_df": IC_tpc_cal_df,
+        "IC_tpc_cal_iovdf": IC_tpc_cal_iovdf,
+    }
+
+def _build_icarus(cal):
+    return {
+        "IC_yz_cal": CalibrationTable(cal["IC_yz_cal_df"], ["iov", "itpc", "plane", "ybin", "zbin"], "scale"),
+        "IC_etau_cal": CalibrationTable(cal["IC_etau_cal_df"], ["iov", "itpc"], "etau"),
+        "IC_tpc_cal": CalibrationTable(cal["IC_tpc_cal_df"], ["iov", "itpc", "plane"], "scale"),
+    }
 
 ##############################
 # SBND TPC calo files
@@ -352,11 +444,6 @@ conn.close()
 SBND_yz_cal_mc_f = "/cvmfs/sbnd.opensciencegrid.org/products/sbnd/sbnd_data/" + sbnd_data_v + "/YZmaps/yz_correction_map_mcp2025b5e18.root"
 SBND_yz_cal_data_f = "/cvmfs/sbnd.opensciencegrid.org/products/sbnd/sbnd_data/" + sbnd_data_v + "/YZmaps/yz_correction_map_data1e20.root"
 
-yz_zbin_sbnd_mc = []
-yz_ybin_sbnd_mc = []
-yz_zbin_sbnd_data = []
-yz_ybin_sbnd_data = []
-
 def call_sbnd_yz_corr(map_f):
     maps = []
     z_edges = y_edges = None
@@ -388,8 +475,111 @@ def call_sbnd_yz_corr(map_f):
     out_df = pd.concat(maps, ignore_index=True)
     return out_df, z_edges, y_edges
 
-SBND_yz_cal_mc_df, yz_zbin_sbnd_mc, yz_ybin_sbnd_mc = call_sbnd_yz_corr(SBND_yz_cal_mc_f)
-SBND_yz_cal_data_df, yz_zbin_sbnd_data, yz_ybin_sbnd_data = call_sbnd_yz_corr(SBND_yz_cal_data_f)
+def _read_sbnd():
+    SBND_yz_cal_mc_df, yz_zbin_sbnd_mc, yz_ybin_sbnd_mc = call_sbnd_yz_corr(SBND_yz_cal_mc_f)
+    SBND_yz_cal_data_df, yz_zbin_sbnd_data, yz_ybin_sbnd_data = call_sbnd_yz_corr(SBND_yz_cal_data_f)
+    return {
+        "SBND_yz_cal_mc_df": SBND_yz_cal_mc_df,
+        "yz_zbin_sbnd_mc": yz_zbin_sbnd_mc,
+        "yz_ybin_sbnd_mc": yz_ybin_sbnd_mc,
+        "SBND_yz_cal_data_df": SBND_yz_cal_data_df,
+        "yz_zbin_sbnd_data": yz_zbin_sbnd_data,
+        "yz_ybin_sbnd_data": yz_ybin_sbnd_data,
+    }
+
+def _build_sbnd(cal):
+    SBND_etau_cal_mc_df = pd.DataFrame( {'iov': [0, 0], 'itpc': [0, 1], 'etau': [SBND_CALO_PARAMS["etau"][0], SBND_CALO_PARAMS["etau"][0]]})
+    SBND_etau_cal_data_df = pd.DataFrame( {'iov': [0, 0], 'itpc': [0, 1], 'etau': [SBND_CALO_PARAMS["etau"][1], SBND_CALO_PARAMS["etau"][1]]})
+    return {
+        "SBND_etau_cal_mc_df": SBND_etau_cal_mc_df,
+        "SBND_etau_cal_data_df": SBND_etau_cal_data_df,
+        "SBND_yz_cal_mc": CalibrationTable(cal["SBND_yz_cal_mc_df"], ["iov", "itpc", "plane", "ybin", "zbin"], "scale"),
+        "SBND_yz_cal_data": CalibrationTable(cal["SBND_yz_cal_data_df"], ["iov", "itpc", "plane", "ybin", "zbin"], "scale"),
+        "SBND_etau_cal_mc": CalibrationTable(SBND_etau_cal_mc_df, ["iov", "itpc"], "etau"),
+        "SBND_etau_cal_data": CalibrationTable(SBND_etau_cal_data_df, ["iov", "itpc"], "etau"),
+    }
 
-SBND_etau_cal_mc_df = pd.DataFrame( {'iov': [0, 0], 'itpc': [0, 1], 'etau': [SBND_CALO_PARAMS["etau"][0], SBND_CALO_PARAMS["etau"][0]]})
-SBND_etau_cal_data_df = pd.DataFrame( {'iov': [0, 0], 'itpc': [0, 1], 'etau': [SBND_CALO_PARAMS["etau"][1], SBND_CALO_PARAMS["etau"][1]]})
+##############################
+# LAZY LOADING
+##############################
+# The templates and calibrations are only read the first time something needs them,
+# once per process. What is read from CVMFS is also kept as an .npz snapshot per data
+# version in CACHE_DIR, so later processes (pool workers, notebooks) skip CVMFS.
+CACHE_DIR = os.environ.get("CAFPYANA_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "cafpyana"))
+
+# group: (data version, reader, builder of the derived objects, names provided)
+_RESOURCES = {
+    "templates": (lambda: larsoft_data_v, _read_templates, None,
+                  ["proton_dedx", "proton_rr", "proton_yerr", "muon_dedx", "muon_rr", "muon_rr_center", "muon_yerr"]),
+    "icarus": (lambda: icarus_data_v, _read_icarus, _build_icarus,
+               ["IC_yz_cal_df", "IC_yz_cal_iovdf", "IC_etau_cal_df", "IC_etau_cal_iovdf", "IC_tpc_cal_df", "IC_tpc_cal_iovdf",
+                "IC_yz_cal", "IC_etau_cal", "IC_tpc_cal"]),
+    "sbnd": (lambda: sbnd_data_v, _read_sbnd, _build_sbnd,
+             ["SBND_yz_cal_mc_df", "yz_zbin_sbnd_mc", "yz_ybin_sbnd_mc", "SBND_yz_cal_data_df", "yz_zbin_sbnd_data", "yz_ybin_sbnd_data",
+              "SBND_etau_cal_mc_df", "SBND_etau_cal_data_df", "SBND_yz_cal_mc", "SBND_yz_cal_data", "SBND_etau_cal_mc", "SBND_etau_cal_data"]),
+}
+_LOADED = {}
+
+def _save_snapshot(path, values):
+    # arrays as-is, DataFrames as one array per column plus "<name>/" for the index
+    arrays = {}
+    for name, v in values.items():
+        if isinstance(v, pd.DataFrame):
+            arrays[name + "/"] = v.index.values
+            for c in v.columns:
+                arrays[name + "/" + c] = v[c].values
+        else:
+            arrays[name] = np.asarray(v)
+    if any(a.dtype == object for a in arrays.values()):
+        return # only plain numeric tables can be stored without pickling
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # a temp file of our own: several workers may write the same snapshot at once
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+def _load_snapshot(path):
+    values = {}
+    with np.load(path, allow_pickle=False) as f:
+        for key in f.files:
+            name, _, col = key.partition("/")
+            if key == name:
+                values[name] = f[key]
+            elif col == "":
+                values[name] = pd.DataFrame(index=f[key])
+            else:
+                values[name][col] = f[key]
+    return values
+
+def _load(group):
+    if group not in _LOADED:
+        version, read, build, _ = _RESOURCES[group]
+        path = os.path.join(CACHE_DIR, "chi2pid_%s_%s.npz" % (group, version()))
+        values = None
+        if os.path.exists(path):
+            try:
+                values = _load_snapshot(path)
+            except (OSError, EOFError, ValueError, KeyError, zipfile.BadZipFile):
+                values = None
+        if values is None:
+            values = read()
+            try:
+                _save_snapshot(path, values)
+            except OSError:
+                pass # read-only home (e.g. grid jobs): just don't cache
+        if build is not None:
+            values.update(build(values))
+        _LOADED[group] = values
+    return _LOADED[group]
+
+def __getattr__(name):
+    # keep the old module attributes (chi2pid.muon_rr, chi2pid.IC_yz_cal_df, ...) working
+    for group, (_, _, _, names) in _RESOURCES.items():
+        if name in names:
+            return _load(group)[name]
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
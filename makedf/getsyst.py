@@ -2,6 +2,25 @@ import uproot
 import numpy as np
 import pandas as pd
 import awkward as ak
+import hashlib
+
+def _weight_matrix(f, nuniv):
+    # rec.mc.nu.wgt.univ holds, per entry, the nuniv weights of each neutrino back to back.
+    # Reshape it once into a dense (neutrino x weight) matrix, plus the (entry, inu) of each row.
+    univ = f["recTree"]['rec.mc.nu.wgt.univ'].arrays(library="ak")['rec.mc.nu.wgt.univ']
+    nnu = ak.to_numpy(ak.num(univ, axis=1)) // nuniv
+    # kept in the branch dtype (float32), the weight frames are stored as such
+    wgts = ak.to_numpy(ak.flatten(univ, axis=None)).reshape(-1, nuniv)
+
+    entry = np.repeat(np.arange(len(nnu)), nnu)
+    inu = np.arange(len(entry)) - np.repeat(np.cumsum(nnu) - nnu, nnu)
+    wgtidx = pd.MultiIndex.from_arrays([entry, inu], names=["entry", "inu"])
+    return wgts, wgtidx
+
+def _syst_rng(s):
+    # Random stream keyed on the systematic name. Unlike the salted built-in hash(),
+    # this gives the same universes in every process and every run.
+    return np.random.default_rng(int.from_bytes(hashlib.sha256(s.encode()).digest()[:8], "little"))
 
 def getsyst(f, systematics, nuind, multisim_nuniv=100, slim=False, slimname="slim"):
     if "globalTree" not in f:
@@ -9,112 +28,98 @@ def getsyst(f, systematics, nuind, multisim_nuniv=100, slim=False, slimname="sli
 
     nuidx = pd.MultiIndex.from_arrays([nuind.index.get_level_values(0), nuind])
 
-    if slim:
-        # one column to save them all
-        cols = pd.MultiIndex.from_product(
-            [[slimname], [f"univ_{i}" for i in range(multisim_nuniv)]],
-        )
-        systs_slim = pd.DataFrame(
-            1.0,
-            index=nuidx,
-            columns=cols,
-        )
-
     globalTree = f["globalTree"]
     wgt_names = [n for n in f["globalTree"]['global/wgts/wgts.name'].arrays(library="np")['wgts.name'][0]]
     wgt_types = f["globalTree"]['global/wgts/wgts.type'].arrays(library="np")['wgts.type'][0]
     wgt_nuniv = f["globalTree"]['global/wgts/wgts.nuniv'].arrays(library="np")['wgts.nuniv'][0]
 
-    isyst = pd.Series(np.repeat(list(range(len(wgt_nuniv))), wgt_nuniv), name="isyst")
-    isyst.index.name = "iwgt"
+    # column range of each systematic in the weight matrix
+    wgt_offset = np.concatenate([[0], np.cumsum(wgt_nuniv)])
     nuniv = wgt_nuniv.sum()
 
-    wgts = ak.to_dataframe(f["recTree"]['rec.mc.nu.wgt.univ'].arrays(library="ak"), how=None)[0]
-    wgts["inu"] = wgts.index.get_level_values(1) // nuniv
-    wgts["iwgt"] = wgts.index.get_level_values(1) % nuniv
-    wgts = wgts.reset_index().set_index(["entry", "inu", "iwgt"]).drop(columns="subentry")
-    wgts.columns = ["wgt"]
-    wgts = wgts.join(isyst)
+    wgts, wgtidx = _weight_matrix(f, nuniv)
+
+    if slim:
+        # one column to save them all
+        systs_slim = np.ones((wgts.shape[0], multisim_nuniv))
+        # unisim knobs are combined at the end: per-neutrino shift (wgt - 1) of each
+        # knob times a per-universe scale drawn from the knob's own random stream
+        slim_shifts = []
+        slim_scales = []
 
+    cols = []
     systs = []
     for s in systematics:
         isyst = wgt_names.index(s)
-        this_systs = []
+        nwgt = wgt_nuniv[isyst]
+        this_wgts = wgts[:, wgt_offset[isyst]:wgt_offset[isyst+1]]
 
         # Get weight type
         # +/- 1,2,3 sigma
-        if wgt_types[isyst] == 3 and wgt_nuniv[isyst] == 1: # morph unisim
-            s_morph = wgts[wgts.isyst == isyst].wgt.groupby(level=[0,1]).first()
-            s_morph.name = (s, "morph")
+        if wgt_types[isyst] == 3 and nwgt == 1: # morph unisim
+            s_morph = this_wgts[:, 0]
 
             if slim:
-                for i in range(multisim_nuniv):
-                    np.random.seed(hash(s+str(i)) % (2**32))
-                    wgt = 1 + (s_morph - 1) * 2 * np.abs(np.random.normal(0, 1)) # std -> unc.
-                    systs_slim[(slimname, f"univ_{i}")] = systs_slim[(slimname, f"univ_{i}")].values * wgt
+                slim_shifts.append(s_morph - 1)
+                slim_scales.append(2 * np.abs(_syst_rng(s).standard_normal(multisim_nuniv))) # std -> unc.
 
             else:
-                this_systs.append(s_morph)
+                cols.append((s, "morph"))
+                systs.append(s_morph)
 
-        elif wgt_types[isyst] == 3 and wgt_nuniv[isyst] > 1: # +/- sigma unisim
-            nwgt = wgts[wgts.isyst == isyst].wgt.groupby(level=[0,1]).size().values[0]
+        elif wgt_types[isyst] == 3 and nwgt > 1: # +/- sigma unisim
             nsigma = nwgt // 2
             for isigma in range(nsigma):
-                s_ps = wgts[wgts.isyst == isyst].wgt.groupby(level=[0,1]).nth(2*isigma)
-                s_ps.name = (s, "ps%i" % (isigma+1))
-                s_ms = wgts[wgts.isyst == isyst].wgt.groupby(level=[0,1]).nth(2*isigma+1)
-                s_ms.name = (s, "ms%i" % (isigma+1))
+                s_ps = this_wgts[:, 2*isigma]
+                s_ms = this_wgts[:, 2*isigma+1]
 
                 if slim and isigma == 0: # use ps1
-                    for i in range(multisim_nuniv):
-                        np.random.seed(hash(s+str(i)) % (2**32))
-                        wgt = 1 + (s_ps - 1) * np.random.normal(0, 1)
-                        wgt = wgt.reset_index(level=2, drop=True)  # Drop the 'iwgt' level to match systs_slim index
-                        systs_slim[(slimname, f"univ_{i}")] = systs_slim[(slimname, f"univ_{i}")].values * wgt
-    
+                    slim_shifts.append(s_ps - 1)
+                    slim_scales.append(_syst_rng(s).standard_normal(multisim_nuniv))
+
                 else:
-                    this_systs.append(s_ps.droplevel(2))
-                    this_systs.append(s_ms.droplevel(2))
+                    cols += [(s, "ps%i" % (isigma+1)), (s, "ms%i" % (isigma+1))]
+                    systs += [s_ps, s_ms]
 
             # check if we also saved the 0-sigma weight. This is conventionally put last
+            cols.append((s, "cv"))
             if nwgt % 2 != 0:
-                s_cv = wgts[wgts.isyst == isyst].wgt.groupby(level=[0,1]).nth(nwgt-1)
-                s_cv.name = (s, "cv")
-                this_systs.append(s_cv.droplevel(2))
+                systs.append(this_wgts[:, nwgt-1])
             # otherwise, assume it's one
             else:
-                this_systs.append(pd.Series(1, index=this_systs[-1].index, name=(s, "cv")))
+                systs.append(np.ones(wgts.shape[0], dtype=wgts.dtype))
 
         elif wgt_types[isyst] == 0: # multisim
-            this_wgts = wgts[wgts.isyst == isyst].wgt.groupby(level=[0,1]).head(multisim_nuniv) # limit to 250 universes
-            this_wgts = this_wgts.reset_index(level=2)
-            this_wgts = this_wgts.pivot_table(values="wgt", index=["entry", "inu"], columns="iwgt")
-            this_wgts.columns = pd.MultiIndex.from_tuples([(s, "univ_%i"% i) for i in range(len(this_wgts.columns))])
+            this_wgts = this_wgts[:, :multisim_nuniv] # limit to multisim_nuniv universes
 
             if slim:
-                for i in range(multisim_nuniv):
-                    systs_slim[(slimname, f"univ_{i}")] = systs_slim[(slimname, f"univ_{i}")].values * this_wgts[(s, f"univ_{i}")]
+                systs_slim *= this_wgts[:, :multisim_nuniv]
 
-            for c in this_wgts.columns:
-                this_systs.append(this_wgts[c])
+            cols += [(s, "univ_%i" % i) for i in range(this_wgts.shape[1])]
+            systs += list(this_wgts.T)
 
         else:
             raise Exception("Cannot decode systematic uncertainty: %s" % s)
 
-        for syst in this_systs:
-            systs.append(syst)
+    # match the weight rows to the requested neutrinos, neutrinos without weights get 1
+    s_idx = wgtidx.get_indexer(nuidx)
 
     if slim:
-        s_idx = systs_slim.index.get_indexer(nuidx)
-        systs_slim.loc[s_idx < 0, :] = 1.
-        systs_slim.index = nuind.index
-        return systs_slim
+        # one knob at a time, so only a (neutrino x universe) temporary is ever allocated
+        for shift, scale in zip(slim_shifts, slim_scales):
+            systs_slim *= 1 + shift[:, None] * scale[None, :]
 
-    else:
-        systs = pd.DataFrame(systs).T
-        s_idx = systs.index.get_indexer(nuidx)
-        systs_match = systs.iloc[s_idx]
-        systs_match.loc[s_idx < 0, :] = 1.
-        systs_match.index = nuind.index
-        return systs_match
+        # the products are taken in float64, the result is stored in the branch dtype
+        systs_match = np.ones((len(nuidx), multisim_nuniv), dtype=wgts.dtype)
+        systs_match[s_idx >= 0] = systs_slim[s_idx[s_idx >= 0]]
+        cols = pd.MultiIndex.from_product([[slimname], [f"univ_{i}" for i in range(multisim_nuniv)]])
+        return pd.DataFrame(systs_match, index=nuind.index, columns=cols)
 
+    elif len(systs) == 0:
+        return pd.DataFrame(index=nuind.index)
+
+    else:
+        systs = np.column_stack(systs)
+        systs_match = np.ones((len(nuidx), systs.shape[1]), dtype=systs.dtype)
+        systs_match[s_idx >= 0] = systs[s_idx[s_idx >= 0]]
+        return pd.DataFrame(systs_match, index=nuind.index, columns=pd.MultiIndex.from_tuples(cols))
@@ -1,4 +1,5 @@
 from pyanalib.pandas_helpers import *
+from pyanalib.segment_helpers import *
 from .branches import *
 from .util import *
 from .calo import *
@@ -36,6 +37,10 @@ TRUE_KE_THRESHOLDS = {"nmu_27MeV": ["muon", 0.027],
                       "nn_0MeV": ["neutron", 0.0]
                       }
 
+## == Primary particle multiplicities in mcdf: "<column name>": <|PDG code|>
+MC_COUNTS = {"nn": 2112, "np": 2212, "nmu": 13, "npi": 211, "npi0": 111,
+             "ng": 22, "nk": 321, "nk0": 310, "nsm": 3112, "nsp": 3222}
+
 def make_envdf(f):
     env = getenv.get_env(f)
     return env
@@ -198,8 +203,8 @@ def make_trkdf(f, scoreCut=False, requiret0=False, requireCosmic=False, mcs=Fals
 
         mcsdf = mcsdf.merge(mcsdf_angle, how="left", left_index=True, right_index=True)
         mcsgroup = list(range(mcsdf.index.nlevels-1))
-        cumlen = mcsdf.seg_length.groupby(level=mcsgroup).cumsum()*14 # convert rad length to cm
-        maxlen = (cumlen*(mcsdf.seg_scatter_angles >= 0)).groupby(level=mcsgroup).max()
+        cumlen = segment_cumsum(mcsdf.seg_length, mcsgroup)*14 # convert rad length to cm
+        maxlen = segment_max(cumlen*(mcsdf.seg_scatter_angles >= 0), mcsgroup)
         trkdf[("pfp", "trk", "mcsP", "len", "", "")] = maxlen
     trkdf[("pfp", "tindex", "", "", "", "")] = trkdf.index.get_level_values(2)
 
@@ -272,10 +277,7 @@ def make_trkhitdf(f, plane=2):
     ihit = df.index.get_level_values(-1)
     df["firsthit"] = ihit == 0
 
-    lasthit = df.groupby(level=list(range(df.index.nlevels-1))).tail(1).copy()
-    lasthit["lasthit"] = True
-    df["lasthit"] = lasthit.lasthit
-    df.lasthit = df.lasthit.fillna(False).infer_objects()
+    df["lasthit"] = segment_last(df.index, list(range(df.index.nlevels-1)))
 
     return df
 
@@ -317,58 +319,68 @@ def make_mcdf(f, branches=mcbranches, primbranches=mcprimbranches):
 
     mcprimdf.index = mcprimdf.index.rename(mcdf.index.names[:2] + mcprimdf.index.names[2:])
 
-    max_proton_KE = mcprimdf[np.abs(mcprimdf.pdg)==PDG["proton"][0]].genE.groupby(level=[0,1]).max() - PDG["proton"][2]
-    mcdf = multicol_add(mcdf, max_proton_KE.rename("max_proton_ke"), default=0.)
-
-    mcdf.max_proton_ke = mcdf.max_proton_ke.fillna(0.)
-
-    # particle counts
-    mcdf = multicol_add(mcdf, (np.abs(mcprimdf.pdg)==2112).groupby(level=[0,1]).sum().rename("nn"))
-    mcdf = multicol_add(mcdf, (np.abs(mcprimdf.pdg)==2212).groupby(level=[0,1]).sum().rename("np"))
-    mcdf = multicol_add(mcdf, (np.abs(mcprimdf.pdg)==13).groupby(level=[0,1]).sum().rename("nmu"))
-    mcdf = multicol_add(mcdf, (np.abs(mcprimdf.pdg)==211).groupby(level=[0,1]).sum().rename("npi"))
-    mcdf = multicol_add(mcdf, (np.abs(mcprimdf.pdg)==111).groupby(level=[0,1]).sum().rename("npi0"))
-    mcdf = multicol_add(mcdf, (np.abs(mcprimdf.pdg)==22).groupby(level=[0,1]).sum().rename("ng"))
-    mcdf = multicol_add(mcdf, (np.abs(mcprimdf.pdg)==321).groupby(level=[0,1]).sum().rename("nk"))
-    mcdf = multicol_add(mcdf, (np.abs(mcprimdf.pdg)==310).groupby(level=[0,1]).sum().rename("nk0"))
-    mcdf = multicol_add(mcdf, (np.abs(mcprimdf.pdg)==3112).groupby(level=[0,1]).sum().rename("nsm"))
-    mcdf = multicol_add(mcdf, (np.abs(mcprimdf.pdg)==3222).groupby(level=[0,1]).sum().rename("nsp"))
-
-    # particle counts w/ threshold
-    for identifier, (particle, threshold) in TRUE_KE_THRESHOLDS.items():
-        this_KE = mcprimdf[np.abs(mcprimdf.pdg)==PDG[particle][0]].genE - PDG[particle][2]
-        mcdf = multicol_add(mcdf, ((np.abs(mcprimdf.pdg)==PDG[particle][0]) & (this_KE > threshold)).groupby(level=[0,1]).sum().rename(identifier))
- 
-    # muon info
-    mudf = mcprimdf[np.abs(mcprimdf.pdg)==13].sort_values(mcprimdf.index.names[:2] + [("genE", "")]).groupby(level=[0,1]).last()
-    mudf.columns = pd.MultiIndex.from_tuples([tuple(["mu"] + list(c)) for c in mudf.columns])
-
-    cpidf = mcprimdf[np.abs(mcprimdf.pdg)==211].sort_values(mcprimdf.index.names[:2] + [("genE", "")]).groupby(level=[0,1]).last()
-    cpidf.columns = pd.MultiIndex.from_tuples([tuple(["cpi"] + list(c)) for c in cpidf.columns])
-
-    pdf = mcprimdf[mcprimdf.pdg==2212].sort_values(mcprimdf.index.names[:2] + [("genE", "")]).groupby(level=[0,1]).last()
-    pdf.columns = pd.MultiIndex.from_tuples([tuple(["p"] + list(c)) for c in pdf.columns])
-
-    # electron info
-    edf = mcprimdf[np.abs(mcprimdf.pdg)==11].sort_values(mcprimdf.index.names[:2] + [("genE", "")]).groupby(level=[0,1]).last()
-    edf.columns = pd.MultiIndex.from_tuples([tuple(["e"] + list(c)) for c in edf.columns])
-
-    mcdf = multicol_merge(mcdf, mudf, left_index=True, right_index=True, how="left", validate="one_to_one")
-    mcdf = multicol_merge(mcdf, cpidf, left_index=True, right_index=True, how="left", validate="one_to_one")
-    mcdf = multicol_merge(mcdf, pdf, left_index=True, right_index=True, how="left", validate="one_to_one")
-    mcdf = multicol_merge(mcdf, edf, left_index=True, right_index=True, how="left", validate="one_to_one")
+    # all the per-neutrino primary particle summaries in one pass over mcprimdf
+    codes, keys = segment_codes(mcprimdf.index, [0,1])
+    pdg = mcprimdf.pdg.values
+    apdg = np.abs(pdg)
+    genE = mcprimdf.genE.values
+
+    # row in mcprimdf of the highest energy particle of a type in each neutrino, or -1.
+    # The extra last entry (-1) is what neutrinos without any primaries look up.
+    def leading(match):
+        sel = np.flatnonzero(match)
+        sel = sel[np.lexsort((genE[sel], codes[sel]))]
+        # sel is sorted by (neutrino, genE): take the last row of each neutrino's run
+        c = codes[sel]
+        last = np.append(c[1:] != c[:-1], True) if len(c) else np.zeros(0, dtype=bool)
+        rows = np.full(len(keys) + 1, -1)
+        rows[c[last]] = sel[last]
+        return rows
+
+    # PDG code x threshold count matrix, one column per count
+    counts = [(name, code, None) for name, code in MC_COUNTS.items()] + \
+        [(identifier, PDG[particle][0], (PDG[particle][2], threshold)) for identifier, (particle, threshold) in TRUE_KE_THRESHOLDS.items()]
+    hit = np.zeros((len(codes), len(counts)), dtype=bool)
+    for i, (_, code, cut) in enumerate(counts):
+        hit[:, i] = apdg == code
+        if cut is not None:
+            hit[:, i] &= genE - cut[0] > cut[1]
+    row, col = np.nonzero(hit)
+    nmatrix = np.bincount(codes[row]*len(counts) + col, minlength=(len(keys) + 1)*len(counts)).reshape(len(keys) + 1, len(counts))
+
+    # neutrino -> position in keys, -1 for neutrinos without primaries
+    inu = keys.get_indexer(mcdf.index)
+    hasnu = inu >= 0
+
+    mcdf = MultiColBuilder(mcdf)
+    prow = leading(apdg == PDG["proton"][0])[inu]
+    max_proton_ke = np.zeros(len(inu), dtype=genE.dtype)
+    max_proton_ke[prow >= 0] = genE[prow[prow >= 0]] - PDG["proton"][2]
+    mcdf.add(max_proton_ke, "max_proton_ke")
+    for i, (name, _, _) in enumerate(counts):
+        n = nmatrix[inu, i]
+        mcdf.add(n if hasnu.all() else np.where(hasnu, n, np.nan), name)
+
+    # leading muon, charged pion, proton and electron info
+    primdf = mcprimdf.reset_index(drop=True)
+    lead = {}
+    for prefix, match in [("mu", apdg == 13), ("cpi", apdg == 211), ("p", pdg == 2212), ("e", apdg == 11)]:
+        lead[prefix] = primdf.reindex(leading(match)[inu]).set_axis(mcdf.index, axis=0)
+        mcdf.add_frame(lead[prefix], prefix)
 
     # primary track variables
-    mcdf.loc[:, ('mu','totp','')] = np.sqrt(mcdf.mu.genp.x**2 + mcdf.mu.genp.y**2 + mcdf.mu.genp.z**2)
-    mcdf.loc[:, ('p','totp','')] = np.sqrt(mcdf.p.genp.x**2 + mcdf.p.genp.y**2 + mcdf.p.genp.z**2)
+    totp = {}
+    for prefix in ["mu", "p"]:
+        genp = lead[prefix].genp
+        totp[prefix] = np.sqrt(genp.x**2 + genp.y**2 + genp.z**2)
+        mcdf.add(totp[prefix], (prefix, 'totp'))
 
     # opening angles
-    mcdf.loc[:, ('mu','dir','x')] = mcdf.mu.genp.x/mcdf.mu.totp
-    mcdf.loc[:, ('mu','dir','y')] = mcdf.mu.genp.y/mcdf.mu.totp
-    mcdf.loc[:, ('mu','dir','z')] = mcdf.mu.genp.z/mcdf.mu.totp
-    mcdf.loc[:, ('p','dir','x')] = mcdf.p.genp.x/mcdf.p.totp
-    mcdf.loc[:, ('p','dir','y')] = mcdf.p.genp.y/mcdf.p.totp
-    mcdf.loc[:, ('p','dir','z')] = mcdf.p.genp.z/mcdf.p.totp
+    for prefix in ["mu", "p"]:
+        for c in ["x", "y", "z"]:
+            mcdf.add(lead[prefix].genp[c]/totp[prefix], (prefix, 'dir', c))
+
+    mcdf = mcdf.build()
 
     return mcdf
 
@@ -391,8 +403,8 @@ def make_all_pandora_df(f):
     slcdf = multicol_merge(slcdf, pfpdf, left_index=True, right_index=True, how="right", validate="one_to_many")
 
     # distance from vertex to track/shower start
-    slcdf = multicol_add(slcdf, dmagdf(slcdf.slc.vertex, slcdf.pfp.trk.start).rename(("pfp", "trk", "dist_to_vertex")))
-    slcdf = multicol_add(slcdf, dmagdf(slcdf.slc.vertex, slcdf.pfp.shw.start).rename(("pfp", "shw", "dist_to_vertex")))
+    slcdf = multicol_set(slcdf, ("pfp", "trk", "dist_to_vertex"), dmagdf(slcdf.slc.vertex, slcdf.pfp.trk.start))
+    slcdf = multicol_set(slcdf, ("pfp", "shw", "dist_to_vertex"), dmagdf(slcdf.slc.vertex, slcdf.pfp.shw.start))
 
     return pfpdf
 
@@ -426,8 +438,9 @@ def make_pandora_df(f, trkScoreCut=False, trkDistCut=50., cutClearCosmic=False,
             #trkhitdf["dqdx_redo"] = dqdx_redo
             #trkhitdf["dedx_bias"] = dedx_bias
             #print(trkhitdf[trkhitdf.rr < 26.].head(50))
+            chi2s = chi2pid.chi2_batch(trkhitdf, ["dedx_redo"], ['muon', 'proton'])
             for par in ['muon', 'proton']:
-                this_chi2_new, this_chi2_ndof = chi2pid.chi2par(trkhitdf, dedxname="dedx_redo", par=par)
+                this_chi2_new, this_chi2_ndof = chi2s[("dedx_redo", par, "chi2")], chi2s[("dedx_redo", par, "ndof")]
                 this_chi2_col = ('pfp', 'trk', 'chi2pid', 'I' + str(plane), 'chi2_' + par + '_new', '')
                 this_ndof_col = ('pfp', 'trk', 'chi2pid', 'I' + str(plane), 'ndof_' + par + '_new', '')
                 trkdf[this_chi2_col] = this_chi2_new
@@ -441,7 +454,7 @@ def make_pandora_df(f, trkScoreCut=False, trkDistCut=50., cutClearCosmic=False,
     slcdf = multicol_merge(slcdf, trkdf, left_index=True, right_index=True, how="right", validate="one_to_many")
 
     # distance from vertex to track start
-    slcdf = multicol_add(slcdf, dmagdf(slcdf.slc.vertex, slcdf.pfp.trk.start).rename(("pfp", "dist_to_vertex")))
+    slcdf = multicol_set(slcdf, ("pfp", "dist_to_vertex"), dmagdf(slcdf.slc.vertex, slcdf.pfp.trk.start))
 
     if trkDistCut > 0:
         slcdf = slcdf[slcdf.pfp.dist_to_vertex < trkDistCut]
@@ -462,7 +475,7 @@ def make_spine_df(f, trkDistCut=-1, requireFiducial=True, **trkArgs):
 
     # merge in tracks
     eslcdf = multicol_merge(eslcdf, partdf, left_index=True, right_index=True, how="right", validate="one_to_many")
-    eslcdf = multicol_add(eslcdf, dmagdf(eslcdf.vertex, eslcdf.particle.start_point).rename("dist_to_vertex"))
+    eslcdf = multicol_set(eslcdf, "dist_to_vertex", dmagdf(eslcdf.vertex, eslcdf.particle.start_point))
 
     if trkDistCut > 0:
         eslcdf = eslcdf[eslcdf.dist_to_vertex < trkDistCut]
@@ -479,8 +492,8 @@ def make_stubs(f, det="ICARUS"):
     stubpdf = loadbranches(f["recTree"], stubplanebranches)
     stubpdf = stubpdf.rec.slc.reco.stub.planes
 
-    stubdf["nplane"] = stubpdf.groupby(level=[0,1,2]).size()
-    stubdf["plane"] = stubpdf.p.groupby(level=[0,1,2]).first()
+    stubdf["nplane"] = segment_size(stubpdf, [0,1,2])
+    stubdf["plane"] = segment_first(stubpdf.p, [0,1,2])
 
     stubhitdf = loadbranches(f["recTree"], stubhitbranches)
     stubhitdf = stubhitdf.rec.slc.reco.stub.planes.hits
@@ -495,22 +508,22 @@ def make_stubs(f, det="ICARUS"):
 
     MIP_dqdx = dEdx2dQdx(1.7) 
 
-    stub_end_charge = stubhitdf.charge[stubhitdf.wire == stubhitdf.hit_w].groupby(level=[0,1,2,3]).first().groupby(level=[0,1,2]).first()
+    stub_end_charge = segment_first(segment_first(stubhitdf.charge[stubhitdf.wire == stubhitdf.hit_w], [0,1,2,3]), [0,1,2])
     stub_end_charge.name = ("endp_charge", "", "")
 
-    stub_pitch = stubpdf.pitch.groupby(level=[0,1,2]).first()
+    stub_pitch = segment_first(stubpdf.pitch, [0,1,2])
     stub_pitch.name = ("pitch", "", "")
 
     stubdir_is_pos = (stubhitdf.hit_w - stubhitdf.vtx_w) > 0.
     when_sum = ((stubhitdf.wire > stubhitdf.vtx_w) == stubdir_is_pos) & (((stubhitdf.wire < stubhitdf.hit_w) == stubdir_is_pos) | (stubhitdf.wire == stubhitdf.hit_w)) 
-    stubcharge = (stubhitdf.charge[when_sum]).groupby(level=[0,1,2,3]).sum().groupby(level=[0,1,2]).first()
+    stubcharge = segment_first(segment_sum(stubhitdf.charge[when_sum], [0,1,2,3]), [0,1,2])
     stubcharge.name = ("charge", "", "")
 
-    stubinccharge = (stubhitdf.charge).groupby(level=[0,1,2,3]).sum().groupby(level=[0,1,2]).first()
+    stubinccharge = segment_first(segment_sum(stubhitdf.charge, [0,1,2,3]), [0,1,2])
     stubinccharge.name = ("inc_charge", "", "")
 
     hit_before_start = ((stubhitdf.wire < stubhitdf.vtx_w) == stubdir_is_pos)
-    stub_inc_sub_charge = (stubhitdf.charge - MIP_dqdx*stubhitdf.ontrack*(~hit_before_start)*stubhitdf.trkpitch).groupby(level=[0,1,2,3]).sum().groupby(level=[0,1,2]).first()
+    stub_inc_sub_charge = segment_first(segment_sum(stubhitdf.charge - MIP_dqdx*stubhitdf.ontrack*(~hit_before_start)*stubhitdf.trkpitch, [0,1,2,3]), [0,1,2])
     stub_inc_sub_charge.name = ("inc_sub_charge", "", "")
 
     stubdf = stubdf.join(stubcharge)
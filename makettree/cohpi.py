@@ -4,7 +4,6 @@ import pandas as pd
 import uproot
 import pyanalib.pandas_helpers as ph
 import awkward as ak
-import numpy as np
 
 def make_cohpi_ttree_mc(dfname, split):
     recodf_key = 'cohpi_' + str(split)
@@ -30,25 +29,26 @@ def make_cohpi_ttree_mc(dfname, split):
 
     wgt_columns = [c for c in list(set(mcnuwgtdf.columns.get_level_values(0)))if (c.startswith("GENIE") or c.startswith("Flux"))]
     #print(wgt_columns)
-    recodf_wgt_out = pd.DataFrame({}, index=matchdf.index)
-    for col in wgt_columns:
-        recodf_wgt_out[col] = np.array([matchdf[col][u].values for u in matchdf[col].columns]).T.tolist()
+    # each systematic stays a (syst, weight) column group, written out as one vector branch
+    recodf_wgt_out = matchdf[wgt_columns]
 
     recodf = recodf.reset_index()
+    recodf.columns = pd.MultiIndex.from_tuples([ph.pad_column_name((col,), recodf_wgt_out) for col in recodf.columns])
     recodf = pd.concat([recodf, recodf_wgt_out], axis = 1)
     
     ## Work for the true df
     mcnuwgtdf = mcnuwgtdf[mcnuwgtdf.nuint_categ == 1]
     mcnuwgtdf = mcnuwgtdf.reset_index()
 
-    truedf_wgt_out = pd.DataFrame({}, index=mcnuwgtdf.index)
-    for col in wgt_columns:
-        truedf_wgt_out[col] = np.array([mcnuwgtdf[col][u].values for u in mcnuwgtdf[col].columns]).T.tolist()
+    truedf_wgt_out = mcnuwgtdf[wgt_columns]
 
     non_syst_columns = [col for col in mcnuwgtdf.columns if not (col[1].startswith("univ") or col[1].startswith("ms") or col[1].startswith("ps") or col[1].startswith("cv") or col[1].startswith("morph"))]
     #print(list(non_syst_columns))
     truedf_out = mcnuwgtdf[non_syst_columns]
     truedf_out.columns = truedf_out.columns.get_level_values(0)
+    # keep the names the dict-based writer used to keep (the last of any duplicates)
+    truedf_out = truedf_out.loc[:, ~truedf_out.columns.duplicated(keep="last")]
+    truedf_out.columns = pd.MultiIndex.from_tuples([ph.pad_column_name((col,), truedf_wgt_out) for col in truedf_out.columns])
     truedf_out = pd.concat([truedf_out, truedf_wgt_out], axis = 1)
     
     return recodf, truedf_out
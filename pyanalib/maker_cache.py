@@ -0,0 +1,290 @@
+"""
+On-disk cache of the frames the dataframe makers return for each input file.
+
+An entry is keyed by the input file (URL, ROOT file UUID and size, plus mtime for
+local files) and by the maker: its qualified name, bytecode, arguments and closure
+values, the values of the global data it uses (branch lists, tables, ...), and the
+source of every repository module the maker reaches through the globals it uses.
+Editing a maker, a helper it calls or a branch list it reads only invalidates that
+maker's entries; the frames of the other makers keep being read back from the cache.
+A maker that depends on an object with no stable value to key on (an open file,
+a lock, ...) is not cached.
+
+Entries are pickle files in one directory, evicted least-recently-used first
+once the directory grows past the size budget.
+"""
+
+import enum
+import functools
+import hashlib
+import inspect
+import os
+import pickle
+import sys
+import sysconfig
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+# source files outside of the repository are not hashed; functions of installed
+# packages (numpy, pandas, ...) are keyed by name only
+_REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_LIBS = tuple(os.path.abspath(p) for k, p in sysconfig.get_paths().items() if k in ("stdlib", "platstdlib", "purelib", "platlib"))
+
+# per-process memo of the function hashes (by code object) and of the hashed source files
+_MAKER_KEYS = {}
+_FILE_HASHES = {}
+# makers already reported as not cacheable
+_UNCACHEABLE = set()
+
+def _file_hash(path):
+    if path not in _FILE_HASHES:
+        with open(path, "rb") as f:
+            _FILE_HASHES[path] = hashlib.sha256(f.read()).hexdigest()
+    return _FILE_HASHES[path]
+
+def _code_names(code):
+    # global names used by a code object and the functions/comprehensions nested in it
+    names = set(code.co_names)
+    for c in code.co_consts:
+        if inspect.iscode(c):
+            names |= _code_names(c)
+    return names
+
+def _code_hash(code, h):
+    # bytecode, names and constants; marshal output is not stable between a freshly
+    # compiled module and one loaded from its .pyc, so it can't be hashed directly
+    h.update(code.co_code)
+    h.update(repr(code.co_names).encode())
+    for c in code.co_consts:
+        if inspect.iscode(c):
+            _code_hash(c, h)
+        elif isinstance(c, frozenset):
+            h.update(repr(sorted(c, key=repr)).encode())
+        else:
+            h.update(repr(c).encode())
+
+def _module_file(obj):
+    mod = sys.modules.get(getattr(obj, "__module__", None) or getattr(obj, "__name__", None))
+    path = getattr(mod, "__file__", None)
+    if path is None or not os.path.abspath(path).startswith(_REPO):
+        return None
+    return os.path.abspath(path)
+
+def _library(obj):
+    # defined in the standard library or an installed package
+    mod = sys.modules.get(getattr(obj, "__module__", None))
+    path = getattr(mod, "__file__", None)
+    return path is not None and os.path.abspath(path).startswith(_LIBS)
+
+class _Unhashable(Exception):
+    """A maker depends on an object that has no stable value to key it on."""
+
+_SCALARS = (str, bytes, int, float, complex, bool, type(None), np.generic)
+
+def _value_hash(v, h, files, seen):
+    # data a maker uses (branch lists, PDG tables, thresholds, ...) by value. Containers
+    # are walked element by element, since reprs of long ones are truncated with "...".
+    if isinstance(v, _SCALARS):
+        h.update(("%s:%r" % (type(v).__name__, v)).encode())
+    elif isinstance(v, np.ndarray):
+        h.update(str((v.dtype, v.shape)).encode())
+        if v.dtype == object:
+            for x in v.ravel():
+                _depends(x, h, files, seen)
+        else:
+            h.update(np.ascontiguousarray(v).tobytes())
+    elif isinstance(v, (pd.DataFrame, pd.Series, pd.Index)):
+        if isinstance(v, pd.DataFrame):
+            h.update(repr((list(v.columns), [str(t) for t in v.dtypes])).encode())
+        else:
+            h.update(repr((type(v).__name__, v.name, str(v.dtype))).encode())
+        try:
+            hashes = pd.util.hash_pandas_object(v) if isinstance(v, pd.Index) else pd.util.hash_pandas_object(v, index=True)
+        except TypeError:  # unhashable cells (lists, ...)
+            raise _Unhashable(type(v).__name__)
+        h.update(hashes.values.tobytes())
+    elif isinstance(v, (list, tuple, set, frozenset)):
+        if isinstance(v, (set, frozenset)):
+            # sorted, set order changes with the string hash seed of each process
+            v = sorted(v, key=repr)
+        h.update(("%s:%i" % (type(v).__name__, len(v))).encode())
+        for x in v:
+            _depends(x, h, files, seen)
+    elif isinstance(v, dict):
+        h.update(("dict:%i" % len(v)).encode())
+        for k, x in v.items():
+            _depends(k, h, files, seen)
+            _depends(x, h, files, seen)
+    elif isinstance(v, enum.Enum) or isinstance(v, np.ufunc) or inspect.isbuiltin(v):
+        h.update(repr(v).encode())
+    else:
+        raise _Unhashable(type(v).__name__)
+
+def _function_hash(f, h, files, seen):
+    # the code of f, its defaults and closure values, and everything it reaches
+    # through its globals: repository functions recursively, repository modules and
+    # classes by source file, anything else by value
+    _code_hash(f.__code__, h)
+    _depends((f.__defaults__, f.__kwdefaults__), h, files, seen)
+    for name in sorted(_code_names(f.__code__)):
+        if name in f.__globals__:
+            h.update(name.encode())
+            _depends(f.__globals__[name], h, files, seen)
+    for cell in f.__closure__ or ():
+        try:
+            v = cell.cell_contents
+        except ValueError:  # not assigned yet
+            continue
+        _depends(v, h, files, seen)
+
+def _depends(obj, h, files, seen):
+    if not isinstance(obj, _SCALARS):
+        if id(obj) in seen:
+            h.update(b"<seen>")
+            return
+        seen.add(id(obj))
+
+    if isinstance(obj, functools.partial):
+        _depends(obj.func, h, files, seen)
+        _depends((obj.args, sorted(obj.keywords.items())), h, files, seen)
+    elif inspect.isfunction(obj):
+        path = _module_file(obj)
+        h.update(("%s.%s" % (obj.__module__, obj.__qualname__)).encode())
+        if path is not None:
+            files.add(path)
+        elif _library(obj):
+            return  # numpy, pandas, ...: the name is enough
+        if obj.__closure__:
+            _function_hash(obj, h, files, seen)
+            return
+        # closure-free functions are memoized on their code object. The code object
+        # is kept in the memo, so its id can't be reused by another one.
+        code = obj.__code__
+        if id(code) not in _MAKER_KEYS:
+            fh = hashlib.sha256()
+            ffiles = set()
+            _function_hash(obj, fh, ffiles, set())
+            _MAKER_KEYS[id(code)] = (code, fh.hexdigest(), ffiles)
+        _, digest, ffiles = _MAKER_KEYS[id(code)]
+        h.update(digest.encode())
+        files |= ffiles
+    elif inspect.ismodule(obj) or inspect.isclass(obj):
+        path = _module_file(obj)
+        if path is not None:
+            files.add(path)
+        else:
+            h.update(str(getattr(obj, "__qualname__", obj.__name__)).encode())
+    else:
+        _value_hash(obj, h, files, seen)
+
+def maker_key(applyf):
+    # None if the maker depends on something that can't be keyed: it is never cached then
+    if not inspect.isfunction(applyf) and not isinstance(applyf, functools.partial):
+        applyf = getattr(applyf, "f", applyf)  # NTupleProc and friends
+
+    files = set()
+    h = hashlib.sha256()
+    try:
+        _depends(applyf, h, files, set())
+    except _Unhashable as e:
+        name = getattr(applyf, "__qualname__", repr(applyf))
+        if name not in _UNCACHEABLE:
+            _UNCACHEABLE.add(name)
+            print("Not caching %s: it depends on a %s, which can't be keyed by value." % (name, str(e)))
+        return None
+    for path in sorted(files):
+        h.update(path.encode() + _file_hash(path).encode())
+    return h.hexdigest()
+
+def file_key(f, url):
+    # f is the open uproot file, url the path it was opened from
+    key = [url, str(f.file.uuid), str(f.file.fEND)]
+    if os.path.exists(url):
+        st = os.stat(url)
+        key += [str(st.st_size), str(st.st_mtime_ns)]
+    return hashlib.sha256("|".join(key).encode()).hexdigest()
+
+class MakerCache(object):
+    """Pickled maker outputs in a directory of at most maxbytes bytes."""
+    def __init__(self, path, maxbytes):
+        self.path = path
+        self.maxbytes = maxbytes
+        self.nbytes = None
+
+    def _entry(self, filekey, makerkey):
+        return os.path.join(self.path, "%s_%s.pkl" % (filekey[:32], makerkey[:32]))
+
+    def get(self, filekey, makerkey):
+        # returns (hit, df); df may legitimately be None
+        entry = self._entry(filekey, makerkey)
+        try:
+            with open(entry, "rb") as f:
+                df = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return False, None
+        # mtime is the LRU clock
+        try:
+            os.utime(entry)
+        except OSError:
+            pass
+        return True, df
+
+    def put(self, filekey, makerkey, df):
+        os.makedirs(self.path, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(df, f, protocol=pickle.HIGHEST_PROTOCOL)
+            size = os.path.getsize(tmp)
+            if size > self.maxbytes:
+                os.remove(tmp)
+                return
+            os.replace(tmp, self._entry(filekey, makerkey))
+        except OSError as e:
+            print("Could not write maker cache entry (%s)" % str(e))
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return
+
+        if self.nbytes is None:
+            self.nbytes = self._size()
+        else:
+            self.nbytes += size
+        if self.nbytes > self.maxbytes:
+            self.evict()
+
+    def _entries(self):
+        entries = []
+        for e in os.scandir(self.path):
+            if not e.name.endswith(".pkl"):
+                continue
+            try:
+                st = e.stat()
+            except OSError:  # removed by another worker
+                continue
+            entries.append((st.st_mtime, st.st_size, e.path))
+        return entries
+
+    def _size(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self):
+        # drop the least recently used entries until the cache is back to 90% of its budget.
+        # Several workers may evict at once, so entries can vanish under us.
+        entries = sorted(self._entries())
+        self.nbytes = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if self.nbytes <= 0.9*self.maxbytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self.nbytes -= size
+
+    def clear(self):
+        for _, _, path in self._entries():
+            os.remove(path)
+        self.nbytes = 0
@@ -13,8 +13,16 @@ import sys
 from functools import partial
 import time
 import uuid
+import bisect
 import tempfile
-
+import shutil
+from collections import deque
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import awkward as ak
+
+from pyanalib.pandas_helpers import FrameCache, compact_dtypes
+from pyanalib import maker_cache
 from makedf.makedf import make_histpotdf
 from makedf.makedf import make_histgenevtdf
 
@@ -43,7 +51,203 @@ class NTupleProc(object):
         self.f = data["f"]
         self.name = data["name"]
 
-def _open_with_retries(path, attempts=5, sleep=2.0):
+# Branches requested from each tree by the makers, learned per worker process.
+# After the first file a worker has processed, every later file reads the union
+# of these branches in a single pass instead of once per loadbranches call.
+_BRANCH_PLAN = {}
+
+# Memory budget for the loadbranches frames memoized for each open file
+FRAME_CACHE_MAXBYTES = 2 * 1024**3
+
+class CachedTree(object):
+    """Per-file view of a TTree that decodes each branch at most once."""
+    def __init__(self, tree, plan=None):
+        self.tree = tree
+        self.plan = plan
+        self.arraycache = {}
+        self.framecache = FrameCache(FRAME_CACHE_MAXBYTES)
+        self._keys = None
+
+    def keys(self, *args, **kwargs):
+        if args or kwargs:
+            return self.tree.keys(*args, **kwargs)
+        if self._keys is None:
+            self._keys = list(self.tree.keys())
+        return self._keys
+
+    def __contains__(self, name):
+        return name in self.tree
+
+    def __getitem__(self, name):
+        return self.tree[name]
+
+    def __getattr__(self, name):
+        return getattr(self.tree, name)
+
+    def arrays(self, branches, library="ak", **uprargs):
+        # anything other than a plain full read goes straight to uproot
+        if library != "ak" or uprargs or isinstance(branches, str):
+            return self.tree.arrays(branches, library=library, **uprargs)
+
+        missing = [b for b in branches if b not in self.arraycache]
+        if missing:
+            toread = list(dict.fromkeys(missing))
+            if self.plan is not None:
+                keys = set(self.keys())
+                toread += [b for b in sorted(self.plan) if b in keys and b not in self.arraycache and b not in missing]
+                self.plan.update(missing)
+
+            # fetch the baskets of every branch in the read up front, in a few large requests
+            source = self.tree.file.source
+            if isinstance(source, CoalescingSource):
+                source.prefetch(basket_ranges(self.tree, toread))
+            try:
+                arrays = self.tree.arrays(toread, library="ak")
+            finally:
+                if isinstance(source, CoalescingSource):
+                    source.release()
+            for b in toread:
+                self.arraycache[b] = arrays[b]
+
+        return ak.zip({b: self.arraycache[b] for b in branches}, depth_limit=1)
+
+    def clear(self):
+        self.arraycache = {}
+        self.framecache.clear()
+
+class CachedFile(object):
+    """Wraps an open uproot file so that every TTree is handed out as a CachedTree."""
+    def __init__(self, f):
+        self.f = f
+        self.trees = {}
+
+    def __contains__(self, name):
+        return name in self.f
+
+    def __getitem__(self, name):
+        if name in self.trees:
+            return self.trees[name]
+        obj = self.f[name]
+        if isinstance(obj, uproot.TTree):
+            obj = CachedTree(obj, _BRANCH_PLAN.setdefault(name, set()))
+            self.trees[name] = obj
+        return obj
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+    def keys(self, *args, **kwargs):
+        return self.f.keys(*args, **kwargs)
+
+    def clear(self):
+        for t in self.trees.values():
+            t.clear()
+        self.trees = {}
+
+# Remote reads: byte ranges less than COALESCE_GAP bytes apart are fetched as one
+# request (the bytes in between are read and dropped), up to COALESCE_MAXBYTES per
+# request, with at most COALESCE_CONCURRENCY requests in flight.
+COALESCE_GAP = 64 * 1024
+COALESCE_MAXBYTES = 32 * 1024**2
+COALESCE_CONCURRENCY = 8
+
+def basket_ranges(tree, branches):
+    # (start, stop) byte ranges of the baskets of branches that are stored on their own
+    # (the last basket of a branch may be embedded in the TTree, already in memory)
+    ranges = []
+    for b in branches:
+        branch = tree[b]
+        for _, r in branch.entries_to_ranges_or_baskets(0, branch.num_entries):
+            if isinstance(r, tuple):
+                ranges.append(r)
+    return ranges
+
+def coalesce_ranges(ranges, gap, maxbytes):
+    # sorted [start, stop) ranges covering ranges, merging neighbours closer than gap
+    merged = []
+    for start, stop in sorted(set(ranges)):
+        if merged and start - merged[-1][1] <= gap and max(stop, merged[-1][1]) - merged[-1][0] <= maxbytes:
+            merged[-1][1] = max(stop, merged[-1][1])
+        else:
+            merged.append([start, stop])
+    return [(start, stop) for start, stop in merged]
+
+class CoalescingSource(object):
+    """Wraps the uproot Source of a remote file. Each set of byte ranges uproot asks
+    for (the baskets of one arrays() call) is coalesced into a few large reads issued
+    concurrently. prefetch() reads a planned set of ranges ahead and keeps them until
+    release(), so uproot's own requests for them are served from memory."""
+    def __init__(self, source, gap=None, maxbytes=None, concurrency=None):
+        self.source = source
+        self.gap = COALESCE_GAP if gap is None else gap
+        self.maxbytes = COALESCE_MAXBYTES if maxbytes is None else maxbytes
+        self.concurrency = COALESCE_CONCURRENCY if concurrency is None else concurrency
+        self.buffers = []  # sorted (start, stop, data)
+
+    def __getattr__(self, name):
+        return getattr(self.source, name)
+
+    def _read(self, ranges):
+        merged = coalesce_ranges(ranges, self.gap, self.maxbytes)
+
+        def fetch(r):
+            data = self.source.chunk(r[0], r[1]).raw_data
+            return r[0], r[1], np.frombuffer(data, dtype=np.uint8)
+
+        if len(merged) == 1:
+            return [fetch(merged[0])]
+        with ThreadPoolExecutor(min(self.concurrency, len(merged))) as ex:
+            return list(ex.map(fetch, merged))
+
+    @staticmethod
+    def _find(buffers, start, stop):
+        # the bytes [start, stop) if one of the buffers holds all of them
+        i = bisect.bisect_right(buffers, (start, float("inf"))) - 1
+        if i >= 0 and buffers[i][1] >= stop:
+            bstart, _, data = buffers[i]
+            return data[start - bstart:stop - bstart]
+        return None
+
+    def prefetch(self, ranges):
+        missing = [r for r in ranges if self._find(self.buffers, *r) is None]
+        if missing:
+            self.buffers = sorted(self.buffers + self._read(missing), key=lambda b: b[:2])
+
+    def release(self):
+        self.buffers = []
+
+    def _chunk(self, start, stop, data):
+        return uproot.source.chunk.Chunk(self, start, stop, uproot.source.futures.TrivialFuture(data))
+
+    def chunk(self, start, stop):
+        data = self._find(self.buffers, start, stop)
+        if data is None:
+            return self.source.chunk(start, stop)
+        return self._chunk(start, stop, data)
+
+    def chunks(self, ranges, notifications):
+        missing = [r for r in ranges if self._find(self.buffers, *r) is None]
+        buffers = self.buffers
+        if missing:
+            buffers = sorted(buffers + self._read(missing), key=lambda b: b[:2])
+        chunks = []
+        for start, stop in ranges:
+            chunk = self._chunk(start, stop, self._find(buffers, start, stop))
+            notifications.put(chunk)
+            chunks.append(chunk)
+        return chunks
+
+def _xrootd_url(fname):
+    # Convert pnfs to xroot URL's
+    if fname.startswith("/pnfs"):
+        return fname.replace("/pnfs", "root://fndcadoor.fnal.gov:1094/pnfs/fnal.gov/usr")
+    # fix xroot URL's
+    elif fname.startswith("xroot"):
+        return fname[1:]
+    return fname
+
+def _open_with_retries(path, attempts=5, sleep=2.0, maxsleep=60.0):
+    # retry with exponential backoff: 2, 4, 8, 16 s, ...
     last_exc = None
     for k in range(attempts):
         try:
@@ -51,34 +255,177 @@ def _open_with_retries(path, attempts=5, sleep=2.0):
         except (OSError, ValueError) as e:
             last_exc = e
             if k + 1 < attempts:
-                time.sleep(sleep * (k + 1))
+                time.sleep(min(sleep * 2**k, maxsleep))
     raise last_exc
 
-def _loaddf(applyfs, preprocess, g):
-    # fname, index, applyfs = inp
-    index, fname = g
-    # Convert pnfs to xroot URL's
-    if fname.startswith("/pnfs"):
-        fname = fname.replace("/pnfs", "root://fndcadoor.fnal.gov:1094/pnfs/fnal.gov/usr")
-    # fix xroot URL's
-    elif fname.startswith("xroot"):
-        fname = fname[1:]
+def _open_input(fname, local=None):
+    # the prefetched local copy if there is a usable one, otherwise stream fname
+    if local is not None:
+        try:
+            return uproot.open(local)
+        except (OSError, ValueError) as e:
+            print(f"Could not open the local copy of {fname} ({e}). Streaming it instead.")
+    f = _open_with_retries(fname)
+    if "://" in fname:
+        f.file._source = CoalescingSource(f.file.source)
+    return f
+
+def _copy(src, dst):
+    # copy an input file to local disk, over XRootD for remote files
+    if src.startswith("root://"):
+        from XRootD import client
+        process = client.CopyProcess()
+        process.add_job(src, dst, force=True)
+        process.prepare()
+        status, results = process.run()
+        if not status.ok or not all(r["status"].ok for r in results):
+            raise OSError("xrdcp %s failed: %s" % (src, status.message))
+    else:
+        shutil.copyfile(src, dst)
+
+class Prefetcher(object):
+    """Copies the upcoming input files to a local scratch directory while the workers
+    are busy with the current ones.
+
+    Wraps the (index, fname) jobs of NTupleGlob.iterdataframes, yielding
+    (index, fname, local) in the same order, where local is the path of the copy (the
+    worker removes it once done) or None if the file is to be streamed. Up to nahead
+    copies run ahead of the files the nproc workers are on; the caller reports each
+    finished file with done(). A copy only starts while the scratch
+    area holds less than maxbytes; if that doesn't happen within wait seconds, or the
+    copy fails, the file is streamed instead.
+    """
+    def __init__(self, scratch=None, nahead=4, maxbytes=20 * 1024**3, nthreads=4, wait=60.):
+        self.scratch = scratch if scratch is not None else tempfile.gettempdir()
+        self.nahead = nahead
+        self.maxbytes = maxbytes
+        self.nthreads = nthreads
+        self.wait = wait
+        self.tmpdir = None
+
+    def _used(self):
+        used = 0
+        for e in os.scandir(self.tmpdir):
+            try:
+                used += e.stat().st_size
+            except OSError:  # removed by a worker
+                pass
+        return used
+
+    def _fetch(self, index, fname):
+        local = os.path.join(self.tmpdir, "input_%i.flat.caf.root" % index)
+        # wait for the workers to free some space
+        start = time.time()
+        while self._used() >= self.maxbytes:
+            if time.time() - start > self.wait:
+                return None
+            time.sleep(0.5)
+        try:
+            _copy(_xrootd_url(fname), local)
+        except Exception as e:
+            print(f"Could not prefetch file ({fname}), it will be streamed instead.")
+            print(e)
+            if os.path.exists(local):
+                os.remove(local)
+            return None
+        return local
+
+    def __call__(self, jobs, nproc=1):
+        os.makedirs(self.scratch, exist_ok=True)
+        self.tmpdir = tempfile.mkdtemp(prefix="cafpyana_prefetch_", dir=self.scratch)
+        # the pool pulls every job out right away, so the window is kept by counting the
+        # files started here that the workers haven't finished (see done())
+        self.slots = threading.Semaphore(nproc + self.nahead)
+        self.stopped = False
+        with ThreadPoolExecutor(max_workers=self.nthreads) as executor:
+            pending = deque()
+            for index, fname in jobs:
+                while not self.slots.acquire(blocking=False):
+                    if not pending:
+                        if not self._acquire():
+                            executor.shutdown(cancel_futures=True)
+                            return
+                        break
+                    # hand out the next file, its worker will free a slot once done
+                    index0, fname0, future = pending.popleft()
+                    yield index0, fname0, future.result()
+                pending.append((index, fname, executor.submit(self._fetch, index, fname)))
+            while pending:
+                index, fname, future = pending.popleft()
+                yield index, fname, future.result()
+
+    def _acquire(self):
+        # wait for a worker to finish a file, False if stopped in the meantime
+        while not self.slots.acquire(timeout=1.):
+            if self.stopped:
+                return False
+        return not self.stopped
+
+    def done(self):
+        # a worker finished one of the files
+        self.slots.release()
+
+    def stop(self):
+        # stop handing out files, e.g. when the pool is torn down early
+        self.stopped = True
+
+    def close(self):
+        self.stop()
+        if self.tmpdir is not None:
+            shutil.rmtree(self.tmpdir, ignore_errors=True)
+            self.tmpdir = None
+
+def _writeshard(dfs, path):
+    # Write one file's frames to a shard and describe them for the parent
+    frames = []
+    with pd.HDFStore(path, mode="w") as store:
+        for i, df in enumerate(dfs):
+            if df is None:
+                frames.append(None)
+                continue
+            key = "df_%i" % i
+            store.put(key=key, value=df, format="fixed")
+            frames.append({"key": key, "nrows": len(df), "nbytes": int(df.memory_usage(deep=True).sum())})
+    # the shard has to survive a crash of the parent once it's reported done
+    with open(path, "rb") as f:
+        os.fsync(f.fileno())
+    return frames
+
+def loadshard(shard):
+    # Read back the list of frames a worker wrote with _writeshard
+    with pd.HDFStore(shard["path"], mode="r") as store:
+        return [None if m is None else store.get(m["key"]) for m in shard["frames"]]
+
+def _loaddf(applyfs, preprocess, g, sharddir=None, compact=None, cache=None, savemeta=False):
+    # g is (index, fname), or (index, fname, local) with a Prefetcher copy of the file
+    index, fname = g[:2]
+    local = g[2] if len(g) > 2 else None
+    meta = {"index": index, "url": fname, "uuid": ""}
+    fname = _xrootd_url(fname)
 
     madef = False
 
     # run any preprocess-ing commands
     tempfiles = []
-    if preprocess is not None:
+    if preprocess:
+        # the preprocessed file is a new temporary file each time, nothing to cache against
+        cache = None
         for i, p in enumerate(preprocess):
             temp_directory = tempfile.gettempdir()
             temp_file_name = os.path.join(temp_directory, "temp%i_%s.flat.caf.root" % (i, str(uuid.uuid4()))) 
-            p.run(fname, temp_file_name)
+            p.run(local if local is not None else fname, temp_file_name)
             tempfiles.append(temp_file_name)
             fname = temp_file_name
+            local = None
 
     try:
         # Open AND close strictly within the context manager
-        with _open_with_retries(fname) as f:
+        with _open_input(fname, local) as rawf:
+            # every maker shares one decoded copy of each branch
+            f = CachedFile(rawf)
+            meta["uuid"] = str(rawf.file.uuid)
+            if cache is not None:
+                filekey = maker_cache.file_key(rawf, fname)
             dfs = []
             totevt = f['TotalEvents'].values()[0]
             if "recTree" not in f:
@@ -86,19 +433,33 @@ def _loaddf(applyfs, preprocess, g):
             elif totevt < 1e-6:
                 print("File (%s) has 0 in TotalEvents. Try only histpotdf & histgenevtdf and skipping other dfs..." % fname)
             else:
-                for applyf in applyfs:
-                    df = applyf(f)  # must fully read from 'f' here
+                for i_f, applyf in enumerate(applyfs):
+                    hit = False
+                    makerkey = maker_cache.maker_key(applyf) if cache is not None else None
+                    if makerkey is not None:
+                        hit, df = cache.get(filekey, makerkey)
+
+                    if not hit:
+                        df = applyf(f)  # must fully read from 'f' here
+
+                        # --- CRITICAL: detach from file-backed/lazy data ---
+                        # If it's a pandas obj, deep-copy; if not, try to materialize.
+                        if isinstance(df, pd.DataFrame):
+                            df = df.copy(deep=True)
+                        elif hasattr(df, "to_numpy"):  # Series / array-like
+                            df = pd.DataFrame(df.to_numpy()).copy(deep=True)
+                        # ---------------------------------------------------
+
+                        if makerkey is not None:
+                            cache.put(filekey, makerkey, df)
+
                     if df is None:
                         dfs.append(None)
                         continue
 
-                    # --- CRITICAL: detach from file-backed/lazy data ---
-                    # If it's a pandas obj, deep-copy; if not, try to materialize.
-                    if isinstance(df, pd.DataFrame):
-                        df = df.copy(deep=True)
-                    elif hasattr(df, "to_numpy"):  # Series / array-like
-                        df = pd.DataFrame(df.to_numpy()).copy(deep=True)
-                    # ---------------------------------------------------
+                    # optional per-column storage dtype profile (pandas_helpers.compact_dtypes)
+                    if compact is not None and compact[i_f]:
+                        df = compact_dtypes(df)
 
                     # Tag with __ntuple and move it to front of MultiIndex
                     df["__ntuple"] = index
@@ -127,18 +488,31 @@ def _loaddf(applyfs, preprocess, g):
             df_histgenevt = df_histgenevt.reorder_levels(new_order)
             dfs.append(df_histgenevt)
 
+            f.clear()
+
     except (OSError, ValueError) as e:
         print(f"Could not open file ({fname}). Skipping...")
         print(e)
+        meta["error"] = "%s: %s" % (type(e).__name__, str(e))
         dfs = None
 
 
     for f in tempfiles:
         os.remove(f)
+    if len(g) > 2 and g[2] is not None and os.path.exists(g[2]):
+        os.remove(g[2])
             
     if not dfs:
-        return None
+        return (meta, None) if savemeta else None
+
+    # In shard mode the frames go straight to disk and only their description
+    # is sent back to the parent
+    if sharddir is not None:
+        path = os.path.join(sharddir, "shard_%i.h5" % index)
+        dfs = {"index": index, "path": path, "frames": _writeshard(dfs, path)}
 
+    if savemeta:
+        return meta, dfs
     return dfs
 
 class NTupleGlob(object):
@@ -154,30 +528,54 @@ class NTupleGlob(object):
             self.glob = glob.glob(g, raise_error=True)
         self.branches = branches
 
-    def dataframes(self, fs, maxfile=None, nproc=1, savemeta=False, preprocess=None):
+    def dataframes(self, fs, maxfile=None, nproc=1, savemeta=False, preprocess=None, compact=None, cache=None):
+        return list(self.iterdataframes(fs, maxfile=maxfile, nproc=nproc, savemeta=savemeta, preprocess=preprocess, compact=compact, cache=cache))
+
+    def iterdataframes(self, fs, maxfile=None, nproc=1, savemeta=False, preprocess=None, sharddir=None, compact=None, cache=None, first_index=0, skip=None, prefetch=None):
+        # Yields the list of dataframes for each file as soon as a worker finishes it,
+        # so the caller only ever holds what it chooses to buffer. With sharddir set,
+        # workers write their frames there and the shard descriptions are yielded instead
+        # (read them back with loadshard). compact is an optional list of flags, one per
+        # maker in fs, selecting which frames get pandas_helpers.compact_dtypes applied.
+        # cache is an optional maker_cache.MakerCache the maker outputs are reused from.
+        # With savemeta, (meta, dfs) is yielded instead, where meta describes the input
+        # file: {"index": its __ntuple, "url": its name in the glob, "uuid": ROOT file UUID}.
+        # Files that could not be read are then yielded too, as (meta, None) with the
+        # reason in meta["error"]. Files are numbered (__ntuple) from first_index, and
+        # the numbers in skip are not processed. prefetch is an optional Prefetcher that
+        # copies the next files to local disk ahead of the workers.
         if not isinstance(fs, list):
             fs = [fs]
 
         thisglob = self.glob 
         if maxfile:
             thisglob = thisglob[:maxfile]
+        jobs = [(i, g) for i, g in enumerate(thisglob, first_index) if skip is None or i not in skip]
 
         if nproc == "auto":
             CPU_COUNT_use = int(CPU_COUNT * 0.8)
-            nproc = min(CPU_COUNT_use, len(thisglob))
+            nproc = max(min(CPU_COUNT_use, len(jobs)), 1)
             print("CPU_COUNT : " + str(CPU_COUNT) + ", len(thisglob): " + str(len(thisglob)) + ", nproc: " + str(nproc))
 
-        ret = []
+        njobs = len(jobs)
+        if prefetch is not None:
+            jobs = prefetch(jobs, nproc)
 
         try:
             with Pool(processes=nproc) as pool:
-                for i, dfs in enumerate(tqdm(pool.imap_unordered(partial(_loaddf, fs, preprocess), enumerate(thisglob)), total=len(thisglob), unit="file", delay=5, smoothing=0.2)):
-                    if dfs is not None:
-                        ret.append(dfs)
+                try:
+                    for i, dfs in enumerate(tqdm(pool.imap_unordered(partial(_loaddf, fs, preprocess, sharddir=sharddir, compact=compact, cache=cache, savemeta=savemeta), jobs), total=njobs, unit="file", delay=5, smoothing=0.2)):
+                        if prefetch is not None:
+                            prefetch.done()
+                        if dfs is not None:
+                            yield dfs
+                finally:
+                    # the pool can only be torn down once its feeder thread is out of the Prefetcher
+                    if prefetch is not None:
+                        prefetch.stop()
         # Ctrl-C handling
         except KeyboardInterrupt:
             print('Received Ctrl-C. Returning dataframes collected so far.')
-
-        return ret
-
-
+        finally:
+            if prefetch is not None:
+                prefetch.close()
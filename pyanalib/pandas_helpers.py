@@ -1,6 +1,8 @@
 import pandas as pd
 import numpy as np
 import awkward as ak
+import re
+from collections import OrderedDict
 
 def broadcast(v, df):
     for vi, ii in zip(v.index.names, df.index.names):
@@ -17,6 +19,10 @@ def broadcast(v, df):
 
     return pd.Series(v_rpt, df.index).rename(v.name) 
 
+def _padded(columns, nlevel):
+    # columns already are a MultiIndex of the wanted depth, nothing to rebuild
+    return isinstance(columns, pd.MultiIndex) and columns.nlevels == nlevel
+
 def multicol_concat(lhs, rhs):
     # Fix the columns
     lhs_col = lhs.columns
@@ -27,8 +33,10 @@ def multicol_concat(lhs, rhs):
     def pad(c):
        return tuple(list(c) + [""]*(nlevel - len(c))) 
 
-    lhs.columns = pd.MultiIndex.from_tuples([pad(c) for c in lhs_col])
-    rhs.columns = pd.MultiIndex.from_tuples([pad(c) for c in rhs_col])
+    if not _padded(lhs_col, nlevel):
+        lhs.columns = pd.MultiIndex.from_tuples([pad(c) for c in lhs_col])
+    if not _padded(rhs_col, nlevel):
+        rhs.columns = pd.MultiIndex.from_tuples([pad(c) for c in rhs_col])
 
     return pd.concat([lhs, rhs], axis=1)
 
@@ -55,10 +63,17 @@ def multicol_add(df, s, default=None, **panda_kwargs):
     # Work around bugs in pandas
 
     # Reindex s to match index of df
-    s = s.reindex(df.index)
+    if not s.index.equals(df.index):
+        s = s.reindex(df.index)
     # fill default
     if default is not None:
-        s.fillna(default, inplace=True)
+        s = s.fillna(default)
+
+    # s is aligned with df now, so a plain left join is just one more column
+    # next to the existing ones -- no need to copy them
+    name = setname if setname is not None else s.name
+    if panda_kwargs.get("how", "left") == "left" and not panda_kwargs.keys() - {"how"} and name not in df.columns:
+        return pd.concat([df, s.to_frame(name)], axis=1, copy=False)
 
     ret = df.join(s,  **panda_kwargs)
     # Another pandas bug work around -- we can't pad with ""'s. So pad with "."'s and map "." -> ""
@@ -79,11 +94,90 @@ def multicol_merge(lhs, rhs, **panda_kwargs):
        c0 = [c] if isinstance(c, str) else list(c)
        return tuple(c0 + [""]*(nlevel - nc)) 
 
-    lhs.columns = pd.MultiIndex.from_tuples([pad(c) for c in lhs_col])
-    rhs.columns = pd.MultiIndex.from_tuples([pad(c) for c in rhs_col])
+    if not _padded(lhs_col, nlevel):
+        lhs.columns = pd.MultiIndex.from_tuples([pad(c) for c in lhs_col])
+    if not _padded(rhs_col, nlevel):
+        rhs.columns = pd.MultiIndex.from_tuples([pad(c) for c in rhs_col])
 
     return lhs.merge(rhs, **panda_kwargs)
 
+def multicol_set(df, name, values):
+    # In-place version of multicol_add for values already aligned with df (a
+    # series on the same index, or a plain array of the same length). The name
+    # is padded to the column depth of df; nothing else in df is rebuilt or copied.
+    if isinstance(name, str):
+        name = (name,)
+    if len(name) > df.columns.nlevels:
+        raise ValueError("Column %s is deeper than the columns of the frame. Use multicol_add." % str(name))
+    if isinstance(values, pd.Series):
+        if not values.index.equals(df.index):
+            raise ValueError("Series %s is not aligned with the frame. Use multicol_add." % str(values.name))
+        values = values.values
+
+    df[pad_column_name(name, df) if df.columns.nlevels > 1 else name[0]] = values
+    return df
+
+class MultiColBuilder(object):
+    """Collects the columns to add to a frame and materializes them all with one concat.
+
+    Columns (add) and frames (add_frame) are aligned to the index of the base frame
+    as they come in and the names are padded once, in build(), to the deepest name.
+    Equivalent to a chain of multicol_add / left multicol_merge calls on the index,
+    without copying the growing frame on every call.
+    """
+    def __init__(self, df):
+        self.index = df.index
+        self.parts = [df]
+        self.cols = {}
+
+    def _flush(self):
+        if self.cols:
+            part = pd.DataFrame(dict(enumerate(self.cols.values())), index=self.index)
+            part.columns = pd.Index(list(self.cols.keys()), tupleize_cols=False)
+            self.parts.append(part)
+            self.cols = {}
+
+    def add(self, s, name=None, default=None):
+        if name is None:
+            name = s.name
+        if isinstance(name, str):
+            name = (name,)
+        if isinstance(s, pd.Series):
+            if not s.index.equals(self.index):
+                s = s.reindex(self.index)
+            if default is not None:
+                s = s.fillna(default)
+            s = s.values
+        elif len(s) != len(self.index):
+            raise ValueError("Column %s has %i rows, expected %i." % (str(name), len(s), len(self.index)))
+        self.cols[tuple(name)] = s
+        return self
+
+    def add_frame(self, df, prefix=()):
+        # left join of df on the index, with prefix prepended to its column names
+        if isinstance(prefix, str):
+            prefix = (prefix,)
+        self._flush()
+        if not df.index.equals(self.index):
+            df = df.reindex(self.index)
+        else:
+            df = df.copy(deep=False)
+        df.columns = pd.Index([tuple(prefix) + (c if isinstance(c, tuple) else (c,)) for c in df.columns], tupleize_cols=False)
+        self.parts.append(df)
+        return self
+
+    def build(self):
+        self._flush()
+        nlevel = max([self.parts[0].columns.nlevels] + [len(c) for p in self.parts[1:] for c in p.columns])
+
+        parts = []
+        for p in self.parts:
+            if not _padded(p.columns, nlevel):
+                names = [c if isinstance(c, tuple) else (c,) for c in p.columns]
+                p = p.set_axis(pd.MultiIndex.from_tuples([pad_column_name(c, nlevel) for c in names]), axis=1)
+            parts.append(p)
+        return pd.concat(parts, axis=1)
+
 def _detect_vectors(branch, tree_keys):
     ret = []
     hierarchy = branch.split(".")
@@ -97,7 +191,50 @@ def _detect_vectors(branch, tree_keys):
 def idarray(ids, lens):
     return np.repeat(ids.values, lens.values)
 
+class FrameCache(object):
+    """LRU cache of loadbranches frames, bounded by their in-memory size."""
+    def __init__(self, maxbytes):
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self.frames = OrderedDict()
+
+    def get(self, key):
+        if key not in self.frames:
+            return None
+        self.frames.move_to_end(key)
+        return self.frames[key][0]
+
+    def put(self, key, df):
+        size = df.memory_usage(index=True).sum()
+        if size > self.maxbytes:
+            return
+        if key in self.frames:
+            self.nbytes -= self.frames.pop(key)[1]
+        self.frames[key] = (df, size)
+        self.nbytes += size
+        while self.nbytes > self.maxbytes:
+            _, (_, evicted) = self.frames.popitem(last=False)
+            self.nbytes -= evicted
+
+    def clear(self):
+        self.frames.clear()
+        self.nbytes = 0
+
 def loadbranches(tree, branches, **uprargs):
+    # Trees handed out by ntuple_glob carry a per-file frame cache. Makers modify
+    # the frames they get back, so always hand out a copy of the cached one.
+    cache = getattr(tree, "framecache", None)
+    if cache is not None and not uprargs:
+        key = tuple(branches)
+        df = cache.get(key)
+        if df is None:
+            df = _loadbranches(tree, branches)
+            cache.put(key, df)
+        return df.copy()
+
+    return _loadbranches(tree, branches, **uprargs)
+
+def _branch_vectors(tree, branches):
     vectors = []
     keys = list(tree.keys())
     for i,branch in enumerate(branches):
@@ -109,7 +246,55 @@ def loadbranches(tree, branches, **uprargs):
         # All the branches must have the same vector structure for this to work
         elif vectors != this_vectors:
             raise ValueError("Branches %s and %s have different vector structures in the CAF." % (branches[0], branch))
-
+    return vectors
+
+def _local_index(counts):
+    # position of each row within its parent, e.g. [2, 0, 3] -> [0, 1, 0, 1, 2]
+    starts = np.cumsum(counts) - counts
+    return np.arange(counts.sum(), dtype=np.int64) - np.repeat(starts, counts)
+
+def _vector_index(tree, vectors, **uprargs):
+    # Build the (entry, v0..index, v1..index, ...) levels straight from the
+    # "..length" offsets. The flatCAF stores every vector level flattened per
+    # entry, so level i has one length per row of level i-1.
+    lengths = tree.arrays([v+"..length" for v in vectors], library="ak", **uprargs)
+
+    counts = lengths[vectors[0]+"..length"]
+    if counts.ndim != 1:
+        return None
+    counts = ak.to_numpy(counts).astype(np.int64)
+    levels = [np.repeat(np.arange(len(counts), dtype=np.int64), counts), _local_index(counts)]
+
+    for v in vectors[1:]:
+        counts = ak.to_numpy(ak.flatten(lengths[v+"..length"], axis=None)).astype(np.int64)
+        if len(counts) != len(levels[0]):
+            return None
+        parent = np.repeat(np.arange(len(counts), dtype=np.int64), counts)
+        levels = [l[parent] for l in levels] + [_local_index(counts)]
+
+    return levels
+
+def _loadvectors(tree, branches, vectors, **uprargs):
+    levels = _vector_index(tree, vectors, **uprargs)
+    if levels is None:
+        return None
+
+    arrays = tree.arrays(branches, library="ak", **uprargs)
+    data = {}
+    for i, b in enumerate(branches):
+        arr = arrays[b]
+        # only plain per-entry lists of numbers are handled here
+        if arr.ndim != 2:
+            return None
+        values = ak.to_numpy(ak.flatten(arr))
+        if len(values) != len(levels[0]):
+            return None
+        data[i] = values
+
+    index = pd.MultiIndex.from_arrays(levels, names=["entry"] + [v+"..index" for v in vectors])
+    return pd.DataFrame(data, index=index)
+
+def _mergevectors(tree, branches, vectors, **uprargs):
     lengths = [ak.to_dataframe(tree.arrays([v+"..length"], library="ak", **uprargs), how="inner") for v in vectors]
     data = ak.to_dataframe(tree.arrays(branches, library="ak", **uprargs), how=None)
 
@@ -150,6 +335,22 @@ def loadbranches(tree, branches, **uprargs):
         # Drop all the metadata info we don't need anymore
         df = df[branches]
 
+    return df
+
+def _loadbranches(tree, branches, **uprargs):
+    vectors = _branch_vectors(tree, branches)
+
+    df = None
+    if len(vectors) > 0:
+        df = _loadvectors(tree, branches, vectors, **uprargs)
+    # Anything the offset-based path can't handle (fixed-size arrays, branches
+    # without the vector structure, ...) goes through the merges
+    if df is None:
+        df = _mergevectors(tree, branches, vectors, **uprargs)
+
+    return _caf_columns(df, branches)
+
+def _caf_columns(df, branches):
     # Setup branch names so df reflects structure of CAF file
     bsplit = [b.split(".") for b in branches]
     # Replace any reserved names
@@ -184,3 +385,75 @@ def pad_column_name(col, pad_ref): # TODO: merge with the above "pad" function
 
 
 
+# Weight frames (makedf/getsyst.py) keep one level-0 column group per systematic,
+# e.g. (s, "cv"), (s, "ps1"), (s, "ms1"), (s, "morph") or (s, "univ_0") ... (s, "univ_<n-1>").
+# These accessors hand a systematic back as one (rows x weights) array.
+UNIV_PREFIX = "univ_"
+
+def weight_systs(df):
+    # systematics in column order: level-0 names with named sub-columns
+    if df.columns.nlevels < 2:
+        return []
+    systs = []
+    for c in df.columns:
+        if c[1] != "" and c[0] not in systs:
+            systs.append(c[0])
+    return systs
+
+def univ_block(df, syst):
+    # only the univ_<i> columns of syst, ordered by universe
+    sub = df[syst]
+    names = sub.columns.get_level_values(0)
+    iuniv = [(int(n[len(UNIV_PREFIX):]), i) for i, n in enumerate(names) if n.startswith(UNIV_PREFIX)]
+    return sub.iloc[:, [i for _, i in sorted(iuniv)]].to_numpy()
+
+# Storage dtypes of compact_dtypes, by the last non-empty level of the column name
+COMPACT_PROFILE = {
+    "plane": np.uint8,
+    "cryo": np.uint8,
+    "producer": np.uint8,
+    "firsthit": bool,
+    "lasthit": bool,
+}
+
+# systematic weight columns: (syst, "univ_<i>"), (syst, "ps1"), (syst, "cv"), ...
+_WEIGHT_COLUMN = re.compile(r"^(univ_\d+|[pm]s\d+|cv|morph)$")
+
+def _compact_dtype(c, col):
+    # the storage dtype of column c, or None to keep it as it is
+    names = [c] if not isinstance(c, tuple) else [l for l in c if l != ""]
+    kind = col.dtype.kind
+    if isinstance(c, tuple) and len(c) > 1 and isinstance(c[1], str) and _WEIGHT_COLUMN.match(c[1]):
+        return np.float32 if kind == "f" else None
+    t = COMPACT_PROFILE.get(names[-1]) if names else None
+    if t is bool and kind == "O":
+        # e.g. after a fillna(False); anything else than booleans is left alone
+        return bool if col.map(lambda v: isinstance(v, (bool, np.bool_))).all() else None
+    if t is None or kind not in "iub":
+        return None
+    lo, hi = (0, 1) if t is bool else (np.iinfo(t).min, np.iinfo(t).max)
+    if len(col) and (col.min() < lo or col.max() > hi):
+        raise ValueError("Column %s has values outside of its compact dtype %s." % (str(c), np.dtype(t).name))
+    return t
+
+def compact_dtypes(df):
+    """Shrink the dtypes of a maker's output frame for storage.
+
+    Every split of a maker gets the same dtypes: they are picked by column name from
+    a fixed profile, never from the values.
+      - systematic weights ((syst, "univ_<i>"), (syst, "ps1"), (syst, "cv"), ...)
+        become float32: ~7 significant digits, relative rounding error <= 6e-8.
+      - the integer id columns in COMPACT_PROFILE (plane, cryo, producer) become uint8.
+        Values that don't fit raise a ValueError instead of wrapping around.
+      - firsthit/lasthit become bool.
+    Every other column (times, positions, energies, POT, ...) keeps its dtype.
+    Categoricals are deliberately not used since the HDF5 fixed format can't store them.
+    """
+    dtypes = {}
+    for c in df.columns:
+        t = _compact_dtype(c, df[c])
+        if t is not None and np.dtype(t) != df[c].dtype:
+            dtypes[c] = t
+    if not dtypes:
+        return df
+    return df.astype(dtypes)
@@ -0,0 +1,127 @@
+"""
+Segmented reductions over the leading index levels of a sorted frame.
+
+Frames from loadbranches are sorted by their index, so all the rows sharing the
+first k index levels (a slice, a particle, a track, ...) sit in one contiguous run.
+The functions here reduce each run with numpy ufunc.reduceat over the run offsets
+instead of a hash-based groupby. They return the same thing as the corresponding
+s.groupby(level=level).<reduction>(), and fall back to exactly that call whenever
+the rows are not sorted or level is not a leading set of levels.
+"""
+
+import numpy as np
+import pandas as pd
+
+def _levels(index, level):
+    if not isinstance(level, (list, tuple)):
+        level = [level]
+    return [l if isinstance(l, int) else index.names.index(l) for l in level]
+
+def segments(index, level):
+    # offsets of the runs of equal leading levels, or None if groupby is needed
+    levels = _levels(index, level)
+    if len(index) == 0 or levels != list(range(len(levels))) or not index.is_monotonic_increasing:
+        return None
+
+    start = np.zeros(len(index), dtype=bool)
+    start[0] = True
+    if isinstance(index, pd.MultiIndex):
+        for c in index.codes[:len(levels)]:
+            start[1:] |= c[1:] != c[:-1]
+    else:
+        v = index.values
+        start[1:] = v[1:] != v[:-1]
+    return np.flatnonzero(start)
+
+def _keys(index, starts, level):
+    keys = index[starts]
+    nkeep = len(_levels(index, level))
+    if isinstance(keys, pd.MultiIndex) and nkeep < keys.nlevels:
+        keys = keys.droplevel(list(range(nkeep, keys.nlevels)))
+    return keys
+
+def segment_codes(index, level):
+    # group of each row as codes into the sorted group keys
+    starts = segments(index, level)
+    if starts is None:
+        levels = _levels(index, level)
+        names = [index.names[l] for l in levels]
+        if isinstance(index, pd.MultiIndex):
+            index = index.droplevel([l for l in range(index.nlevels) if l not in levels])
+        if len(index) == 0:
+            return np.zeros(0, dtype=np.int64), index
+        codes, keys = index.factorize(sort=True)
+        keys.names = names
+        return codes, keys
+    start = np.zeros(len(index), dtype=np.int64)
+    start[starts] = 1
+    return np.cumsum(start) - 1, _keys(index, starts, level)
+
+def segment_size(s, level):
+    starts = segments(s.index, level)
+    if starts is None:
+        return s.groupby(level=level).size()
+    return pd.Series(np.diff(np.append(starts, len(s.index))), index=_keys(s.index, starts, level))
+
+def _reduce(s, level, how, ufunc):
+    starts = segments(s.index, level)
+    if starts is None:
+        return getattr(s.groupby(level=level), how)()
+    return pd.Series(ufunc(s.values, starts), index=_keys(s.index, starts, level), name=s.name)
+
+def _sum(v, starts):
+    # integers are summed in 64 bits (groupby keeps narrow integer types, which can overflow)
+    if v.dtype.kind in "bi":
+        v = v.astype(np.int64)
+    elif v.dtype.kind == "u":
+        v = v.astype(np.uint64)
+    elif v.dtype.kind == "f":
+        v = np.where(np.isnan(v), 0., v)
+    return np.add.reduceat(v, starts)
+
+def _max(v, starts):
+    return (np.fmax if v.dtype.kind == "f" else np.maximum).reduceat(v, starts)
+
+def _first(v, starts):
+    # first non-NaN value of each run
+    n = len(v)
+    pos = np.where(pd.isna(v), n, np.arange(n))
+    first = np.minimum.reduceat(pos, starts)
+    if (first < n).all():
+        return v[first]
+    out = v[np.minimum(first, n - 1)].astype(np.float64 if v.dtype.kind in "iub" else v.dtype)
+    out[first == n] = np.nan
+    return out
+
+def segment_sum(s, level):
+    return _reduce(s, level, "sum", _sum)
+
+def segment_max(s, level):
+    return _reduce(s, level, "max", _max)
+
+def segment_first(s, level):
+    return _reduce(s, level, "first", _first)
+
+def segment_cumsum(s, level):
+    # running sum within each run (NaN rows stay NaN), aligned with s
+    starts = segments(s.index, level)
+    if starts is None:
+        return s.groupby(level=level).cumsum()
+    v = s.values
+    isnan = np.isnan(v) if v.dtype.kind == "f" else np.zeros(len(v), dtype=bool)
+    total = np.cumsum(np.where(isnan, 0, v))
+    before = np.append(0, total[starts[1:] - 1])
+    out = total - np.repeat(before, np.diff(np.append(starts, len(v))))
+    if isnan.any():
+        out = out.astype(np.float64)
+        out[isnan] = np.nan
+    return pd.Series(out, index=s.index, name=s.name)
+
+def segment_last(index, level):
+    # boolean mask of the last row of each group
+    starts = segments(index, level)
+    if starts is None:
+        return (pd.Series(0, index=index).groupby(level=level).cumcount(ascending=False) == 0).values
+    last = np.zeros(len(index), dtype=bool)
+    last[np.append(starts[1:] - 1, len(index) - 1)] = True
+    return last
@@ -1,31 +1,322 @@
 """
-Helper functions for working with the HDF5 df files.  
+Helper functions for working with the df files.  
 
 Each dataset (identified by a *key*) is stored as a set of smaller dfs (one per split),
 so that very large samples can be handled in chunks.  
+
+Two on-disk formats are supported:
+  - HDF5 (``<name>.df``): one PyTables file, every split stored with format="fixed".
+  - Parquet (``<name>.pqdf``): a directory holding one ``<key>.parquet`` file per split.
+    Parquet files can be read column-by-column. MultiIndex columns are flattened by
+    joining the levels with COLUMN_SEP, and the number of levels is kept in the file
+    metadata so the columns can be rebuilt exactly on read. Runs of weight universe
+    columns (syst, "univ_0", ...) ... (syst, "univ_<n-1>", ...) are packed into a single
+    fixed-size-list column, i.e. one contiguous (rows x n) block per systematic.
+    They are unpacked transparently by get(); read_univ_blocks returns the blocks
+    as arrays without building the per-universe columns.
 """
 
+import os
+import json
+import dill
+import numpy as np
 import pandas as pd
+from pyanalib.pandas_helpers import UNIV_PREFIX, weight_systs, univ_block
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+COLUMN_SEP = "|"
+PARQUET_SUFFIX = ".parquet"
+_PARQUET_META = b"cafpyana"
+# universe name of a packed block
+_PACKED = UNIV_PREFIX + "*"
+
+def is_parquet(file):
+    return os.path.isdir(file)
+
+def encode_columns(columns):
+    # MultiIndex -> flat string names. Level values are stored as strings.
+    if columns.nlevels == 1:
+        return [str(c) for c in columns], 1
+    return [COLUMN_SEP.join(str(l) for l in c) for c in columns], columns.nlevels
+
+def decode_columns(names, nlevels):
+    if nlevels == 1:
+        return pd.Index(names)
+    return pd.MultiIndex.from_tuples([tuple(n.split(COLUMN_SEP, nlevels - 1)) for n in names])
+
+def _is_univ(c, i):
+    # (syst, "univ_<i>", "", ...): the universe name at level 1, as in univ_block, and
+    # the levels after it padding (multicol_concat pads the weights to the frame depth)
+    return c[1] == UNIV_PREFIX + str(i) and all(l == "" for l in c[2:])
+
+def _univ_groups(columns):
+    # contiguous runs of (syst, "univ_0", ...) ... (syst, "univ_<n-1>", ...) columns -> [(start, n)]
+    groups = []
+    if columns.nlevels < 2:
+        return groups
+    i = 0
+    while i < len(columns):
+        n = 0
+        while i + n < len(columns) and columns[i + n][0] == columns[i][0] and _is_univ(columns[i + n], n):
+            n += 1
+        if n > 1:
+            groups.append((i, n))
+        i += max(n, 1)
+    return groups
+
+def _packed_name(name):
+    # flat name of a universe column -> flat name of its packed block, None for other columns
+    parts = name.split(COLUMN_SEP)
+    if len(parts) < 2 or not parts[1].startswith(UNIV_PREFIX):
+        return None
+    parts[1] = _PACKED
+    return COLUMN_SEP.join(parts)
+
+def _unpack_block(column, n):
+    values = column.combine_chunks().flatten().to_numpy(zero_copy_only=False)
+    return values.reshape(-1, n)
+
+class ParquetStore(object):
+    """Directory of parquet files with the put/get interface of pd.HDFStore
+    that run_df_maker uses."""
+    def __init__(self, path, mode="a", compression="zstd", pack_universes=True):
+        self.path = str(path)
+        self.compression = compression
+        self.pack_universes = pack_universes
+        if mode == "w" and os.path.isdir(self.path):
+            for f in os.listdir(self.path):
+                if f.endswith(PARQUET_SUFFIX):
+                    os.remove(os.path.join(self.path, f))
+        if mode != "r":
+            os.makedirs(self.path, exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        pass
+
+    def _file(self, key):
+        return os.path.join(self.path, key.lstrip("/") + PARQUET_SUFFIX)
+
+    def keys(self):
+        return sorted("/" + f[:-len(PARQUET_SUFFIX)] for f in os.listdir(self.path) if f.endswith(PARQUET_SUFFIX))
+
+    def __contains__(self, key):
+        return os.path.exists(self._file(key))
+
+    def put(self, key, value, format=None):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        names, nlevels = encode_columns(value.columns)
+        groups = []
+        if self.pack_universes:
+            groups = [(i, n) for i, n in _univ_groups(value.columns) if value.dtypes.iloc[i:i + n].nunique() == 1]
+        inblock = np.zeros(len(names), dtype=bool)
+        for i, n in groups:
+            inblock[i:i + n] = True
+
+        flat = value.iloc[:, ~inblock] if groups else value.copy(deep=False)
+        flat.columns = [n for n, b in zip(names, inblock) if not b]
+        table = pa.Table.from_pandas(flat, preserve_index=True)
+
+        # each universe run goes in as one fixed-size-list column, where the run started
+        packed = {}
+        for i, n in groups:
+            block = value.iloc[:, i:i + n].to_numpy()
+            name = _packed_name(names[i])
+            table = table.add_column(int((~inblock[:i]).sum()) + len(packed), name,
+                                     pa.FixedSizeListArray.from_arrays(pa.array(block.ravel()), n))
+            packed[name] = n
+
+        meta = dict(table.schema.metadata or {})
+        meta[_PARQUET_META] = json.dumps({"nlevels": nlevels, "packed": packed}).encode()
+        table = table.replace_schema_metadata(meta)
+
+        # write-then-rename so readers never see a partial file
+        path = self._file(key)
+        pq.write_table(table, path + ".tmp", compression=self.compression)
+        os.replace(path + ".tmp", path)
+
+    def _meta(self, key):
+        import pyarrow.parquet as pq
+
+        schema = pq.read_schema(self._file(key))
+        meta = json.loads(schema.metadata[_PARQUET_META])
+        index_cols = set(c for c in schema.pandas_metadata["index_columns"] if isinstance(c, str))
+        return schema, meta["nlevels"], meta.get("packed", {}), index_cols
+
+    def _flatnames(self, names, packed):
+        # stored names -> one name per logical column
+        out = []
+        for name in names:
+            if name in packed:
+                parts = name.split(COLUMN_SEP)
+                k = parts.index(_PACKED)
+                out += [COLUMN_SEP.join(parts[:k] + [UNIV_PREFIX + str(i)] + parts[k + 1:]) for i in range(packed[name])]
+            else:
+                out.append(name)
+        return out
+
+    def columns(self, key):
+        # the stored columns, read from the file schema only
+        schema, nlevels, packed, index_cols = self._meta(key)
+        return decode_columns(self._flatnames([n for n in schema.names if n not in index_cols], packed), nlevels)
+
+    def get(self, key, columns=None):
+        import pyarrow.parquet as pq
+
+        schema, nlevels, packed, index_cols = self._meta(key)
+        read = None
+        if columns is not None:
+            columns = [COLUMN_SEP.join(str(l) for l in c) if isinstance(c, tuple) else c for c in columns]
+            read = list(dict.fromkeys(_packed_name(c) if _packed_name(c) in packed else c for c in columns))
+        table = pq.read_table(self._file(key), columns=read, use_pandas_metadata=True)
+
+        blocks = [n for n in table.column_names if n in packed]
+        df = table.drop(blocks).to_pandas() if blocks else table.to_pandas()
+        if blocks:
+            expanded = [pd.DataFrame(_unpack_block(table.column(n), packed[n]), index=df.index,
+                                     columns=self._flatnames([n], packed)) for n in blocks]
+            order = self._flatnames([n for n in table.column_names if n not in index_cols], packed)
+            df = pd.concat([df] + expanded, axis=1)[columns if columns is not None else order]
+        df.columns = decode_columns(list(df.columns), nlevels)
+        return df
+
+    def get_blocks(self, key, systs=None):
+        # (index, {syst: (rows x universes) array}) straight from the packed columns
+        import pyarrow.parquet as pq
+
+        schema, nlevels, packed, index_cols = self._meta(key)
+        names = [n for n in packed if systs is None or decode_columns([n], nlevels)[0][0] in systs]
+        table = pq.read_table(self._file(key), columns=names, use_pandas_metadata=True)
+        index = table.drop(names).to_pandas().index
+        return index, {decode_columns([n], nlevels)[0][0]: _unpack_block(table.column(n), packed[n]) for n in names}
+
+def open_store(file, mode="a", format="hdf5", compression="zstd"):
+    if format == "parquet":
+        return ParquetStore(file, mode=mode, compression=compression)
+    return pd.HDFStore(file, mode=mode)
+
+def read_df(file, key, columns=None):
+    # columns: list of column prefixes, e.g. [("slc", "vertex"), "nu_score"]. Parquet
+    # files only read the matching columns, HDF5 files are read fully and projected.
+    if is_parquet(file):
+        store = ParquetStore(file, mode="r")
+        if columns is None:
+            return store.get(key)
+        return store.get(key, columns=list(select_columns(store.columns(key), columns)))
+
+    df = pd.read_hdf(file, key=key)
+    if columns is not None:
+        df = df[select_columns(df.columns, columns)]
+    return df
+
+def read_univ_blocks(file, key, systs=None):
+    # Universe weights of each systematic as a (rows x universes) array, together with
+    # the frame index. Parquet files read the packed blocks directly.
+    if is_parquet(file):
+        return ParquetStore(file, mode="r").get_blocks(key, systs)
+
+    df = pd.read_hdf(file, key=key)
+    if systs is None:
+        systs = weight_systs(df)
+    blocks = {s: univ_block(df, s) for s in systs}
+    return df.index, {s: b for s, b in blocks.items() if b.shape[1] > 0}
+
+def select_columns(columns, selectors):
+    # keep the columns that start with any of the selector prefixes
+    prefixes = [s if isinstance(s, tuple) else (s,) for s in selectors]
+    def match(c):
+        c = c if isinstance(c, tuple) else (c,)
+        return any(c[:len(p)] == p for p in prefixes)
+    return columns[[match(c) for c in columns]]
 
 def get_n_split(file):
-    this_split_df = pd.read_hdf(file, key="split")
+    this_split_df = read_df(file, "split")
     this_n_split = this_split_df.n_split.iloc[0]
     return this_n_split
 
 def print_keys(file):
-    with pd.HDFStore(file, mode='r') as store:
+    with open_store(file, mode='r', format="parquet" if is_parquet(file) else "hdf5") as store:
         keys = store.keys()       # list of all keys in the file
         print("Keys:", keys)
 
-def load_dfs(file, keys2load, n_max_concat=100):
+def _for_key(option, key):
+    # options can be given once for every key or as a {key: value} dict
+    if isinstance(option, dict):
+        return option.get(key)
+    return option
+
+def _load_split(file, key, columns, predicate):
+    df = read_df(file, key, columns)
+    if predicate is not None:
+        if isinstance(predicate, bytes):
+            predicate = dill.loads(predicate)
+        df = df[predicate(df)]
+    return df
+
+def load_dfs(file, keys2load, n_max_concat=100, columns=None, predicate=None, nproc=1):
+    """Load the first n_max_concat splits of each key and concatenate them.
+
+    columns:   column prefixes to load, either one list for every key or a dict
+               {key: [prefixes]}. Parquet files only read those columns.
+    predicate: function of a split's (projected) dataframe returning a row mask,
+               applied to each split before concatenation.
+    nproc:     number of splits read in parallel. Parquet splits are read on threads,
+               HDF5 splits in separate processes since PyTables is not thread-safe.
+    """
     out_df_dict = {}
     this_n_keys = get_n_split(file)
     n_concat = min(n_max_concat, this_n_keys)
+
+    jobs = [(key, i) for key in keys2load for i in range(n_concat)]
+    if nproc > 1:
+        if is_parquet(file):
+            executor = ThreadPoolExecutor(max_workers=nproc)
+            pred = predicate
+        else:
+            executor = ProcessPoolExecutor(max_workers=nproc)
+            pred = dill.dumps(predicate) if predicate is not None else None
+        with executor:
+            futures = [executor.submit(_load_split, file, f"{key}_{i}", _for_key(columns, key), pred) for key, i in jobs]
+            splits = [fut.result() for fut in futures]
+    else:
+        splits = [_load_split(file, f"{key}_{i}", _for_key(columns, key), predicate) for key, i in jobs]
+
     for key in keys2load:
-        dfs = []  # collect all splits for this key
-        for i in range(n_concat):
-            this_df = pd.read_hdf(file, key=f"{key}_{i}")
-            dfs.append(this_df)
+        dfs = [df for (k, _), df in zip(jobs, splits) if k == key]  # collect all splits for this key
         out_df_dict[key] = pd.concat(dfs, ignore_index=False)
 
     return out_df_dict
+
+def iter_splits(file, keys2load, columns=None, predicate=None, prefetch=1, n_max=None):
+    """Iterate over the splits of a df file, yielding {key: dataframe} for each split.
+
+    Only the current split and up to `prefetch` upcoming ones are in memory; the
+    upcoming splits are read on a background thread while the caller works on the
+    current one. columns and predicate are as in load_dfs, and either can also be
+    a {key: value} dict.
+    """
+    n_split = get_n_split(file)
+    if n_max is not None:
+        n_split = min(n_split, n_max)
+
+    def load(i):
+        return {key: _load_split(file, f"{key}_{i}", _for_key(columns, key), _for_key(predicate, key)) for key in keys2load}
+
+    # a single reader thread, so HDF5 files are never read concurrently
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        pending = deque(executor.submit(load, i) for i in range(min(prefetch + 1, n_split)))
+        next_split = len(pending)
+        while pending:
+            yield pending.popleft().result()
+            # top up only once the caller is done with this split: at most prefetch upcoming ones are loaded
+            if next_split < n_split:
+                pending.append(executor.submit(load, next_split))
+                next_split += 1
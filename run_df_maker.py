@@ -1,11 +1,19 @@
 #!/usr/bin/env python3 
 import os,sys,time
+import json
 import datetime
 import pathlib
 #from TimeTools import *
 import argparse
 import tables
-from pyanalib.ntuple_glob import NTupleGlob
+import tempfile
+import shutil
+import re
+from concurrent.futures import ThreadPoolExecutor
+import uproot
+from pyanalib.ntuple_glob import NTupleGlob, Prefetcher, loadshard, _xrootd_url
+from pyanalib.split_df_helpers import open_store, read_df
+from pyanalib.maker_cache import MakerCache
 import pandas as pd
 import warnings
 
@@ -13,6 +21,10 @@ warnings.simplefilter(action='ignore', category=pd.errors.PerformanceWarning)
 warnings.filterwarnings("ignore", category=tables.exceptions.NaturalNameWarning)
 pd.set_option('future.no_silent_downcasting', True)
 
+# key of the table of input files in the output: which file went into which __ntuple and split
+INPUTS_KEY = "inputs"
+INPUTS_COLUMNS = ["url", "uuid", "__ntuple", "split"]
+
 ## Arguments
 parser = argparse.ArgumentParser(
     description="Data frame maker command: process input flatcaf files and generate output dataframes.",
@@ -25,6 +37,10 @@ Examples:
   -- Use Grid (adding -ngrid to an integer > 0 will automatically submit grid jobs)
   $ python run_df_maker.py -ngrid 2 -c ./configs/cohpi_slcdf.py -o test_cohpi_slcdf -i input_0.root,input_1.root,...
 
+  -- Add only the files that are new in a (grown) input list to an existing output
+  $ python run_df_maker.py -incremental -c ./configs/cohpi_slcdf.py -o test_cohpi_slcdf -l input.list
+    (add -recheck to also reprocess the files that were replaced at the same URL since)
+
   -- Note!!
   Output df files are sent to /pnfs/<exp>/scratch/users/<User>/cafpyana_out in Grid mode
 """,
@@ -38,11 +54,193 @@ parser.add_argument('-ncpu', dest='NCPU', default=-1, type=int, help="Number of
 parser.add_argument('-ngrid', dest='NGridJobs', default=0, type=int, help="Number of grid jobs. Default = 0, no grid submission.")
 parser.add_argument('-nfile', dest='NFiles', default=0, type=int, help="Number of files to run. Default = 0, run all input files.")
 parser.add_argument('-split', dest='SplitSize', default=1.0, type=float, help="Split size in GB before writing to HDF5. Default = 1.0 GB.")
+parser.add_argument('-format', dest='Format', default="hdf5", choices=["hdf5", "parquet"], help="Output format. hdf5 writes a single <output>.df file, parquet writes an <output>.pqdf directory\nwith one file per split that can be read column-by-column. Default = hdf5.")
+parser.add_argument('-compression', dest='Compression', default="zstd", help="Compression codec for the parquet format (zstd, lz4, snappy, ...). Default = zstd.")
+parser.add_argument('-compact', dest='Compact', action='store_true', help="Store systematic weights as float32, plane/cryo/producer ids as uint8 and firsthit/lasthit as bool\n(see pyanalib.pandas_helpers.compact_dtypes). All other columns keep their dtype.")
+parser.add_argument('-prefetch', dest='Prefetch', default=0, type=int, help="Copy up to this many of the upcoming input files to local scratch space while the workers\nprocess the current ones. Default = 0, stream every file.")
+parser.add_argument('-prefetchdir', dest='PrefetchDir', default="", help="Scratch directory for -prefetch. Default is the system temporary directory.")
+parser.add_argument('-prefetchsize', dest='PrefetchSize', default=20.0, type=float, help="Disk budget of -prefetch in GB. Files that don't fit are streamed. Default = 20 GB.")
+parser.add_argument('-cache', dest='CacheDir', default="", help="Directory of the per-file maker output cache. When set, the frame each maker returns for each input\nfile is kept there and reused on later runs as long as the file, the maker code and its arguments\nare unchanged. Not used with PREPROCESS steps.")
+parser.add_argument('-cachesize', dest='CacheSize', default=50.0, type=float, help="Size limit of the -cache directory in GB, least recently used entries are evicted first. Default = 50 GB.")
+parser.add_argument('-incremental', dest='Incremental', action='store_true', help="Only process the input files that are not in the output yet (matched by URL) and append them\nto it as new splits. The output must come from a run with the same config.")
+parser.add_argument('-recheck', dest='Recheck', action='store_true', help="With -incremental, also reopen every input file already in the output and process again the ones\nwhose ROOT file UUID changed (replaced at the same URL). Costs one open per file, remote ones included.")
+parser.add_argument('-resume', dest='Resume', action='store_true', help="Keep the per-file shards in <output>.shards and log each finished file to <output>.journal, so that\nrerunning the same command after a crash or Ctrl-C only processes the files that were not done yet.\nBoth are removed once the output is written.")
+parser.add_argument('-shard', dest='ShardDir', default="", help="Directory for per-worker shard files. When set, each worker writes its dataframes there\ninstead of sending them to the parent, and the shards are merged into the output at the end.")
 
 args = parser.parse_args()
 
+def write_split(hdf_pd, df_buffers, k_idx):
+    # Concatenate and save accumulated DataFrames
+    for k, buffer in df_buffers.items():
+        if buffer:  # only if buffer has data
+            concat_df = pd.concat(buffer, ignore_index=False)
+            this_key = k + "_" + str(k_idx)
+            try:
+                hdf_pd.put(key=this_key, value=concat_df, format="fixed")
+                print(f"Saved {this_key}: {concat_df.memory_usage(deep=True).sum() / (1024**3):.4f} GB")
+            except Exception as e:
+                print(f"Table {this_key} failed to save, skipping. Exception: {str(e)}")
+            del concat_df
+
+def write_dfs(hdf_pd, dfss, names, k_idx=0):
+    # Buffer the per-file dataframes and write a new split each time SplitSize is reached.
+    # dfss yields (meta, dfs) for each input file and splits are numbered from k_idx.
+    # Returns the number of the next split and the input table rows of the files written.
+    inputs = []
+    split_margin = args.SplitSize
+    size_counters = {k: 0 for k in names}
+    df_buffers = {k: [] for k in names}
+
+    for meta, dfs in dfss:
+        inputs.append([meta["url"], meta["uuid"], meta["index"], k_idx])
+        this_NAMES = names
+        if len(dfs) == 2: ## no or empty recTree
+            this_NAMES = ["histpotdf", "histgenevtdf"]
+
+        for k, df in zip(reversed(this_NAMES), reversed(dfs)):
+            size_bytes = df.memory_usage(deep=True).sum() if df is not None else 0
+            size_counters[k] += size_bytes / (1024**3)
+            if df is not None:
+                df_buffers[k].append(df)  # accumulate
+
+            del df
+
+        if any(val > split_margin for val in size_counters.values()):
+            write_split(hdf_pd, df_buffers, k_idx)
+            # Reset counters and buffers
+            k_idx += 1
+            size_counters = {k: 0 for k in names}
+            df_buffers = {k: [] for k in names}
+
+    # the last flush may have emptied the buffers exactly at the end
+    if any(df_buffers.values()):
+        write_split(hdf_pd, df_buffers, k_idx)
+        k_idx += 1
+
+    return k_idx, inputs
+
+def iter_shards(shards):
+    # Merge step for shard mode: read the shards back in input order, deleting each once used
+    for meta, shard in sorted(shards, key=lambda s: s[1]["index"]):
+        dfs = loadshard(shard)
+        os.remove(shard["path"])
+        yield meta, dfs
+
+def read_journal(path, inputs, first_index):
+    # files finished by an earlier -resume run, {index: (meta, shard)}
+    done = {}
+    if not os.path.exists(path):
+        return done
+    with open(path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:  # last line cut short by the crash
+                continue
+            meta, shard = entry["meta"], entry["shard"]
+            i = meta["index"] - first_index
+            if i < 0 or i >= len(inputs) or inputs[i] != meta["url"]:
+                print(f"{path} was written for a different list of input files. Remove it to start over.")
+                sys.exit(1)
+            if shard is not None and os.path.exists(shard["path"]):
+                done[meta["index"]] = (meta, shard)
+            else:
+                done.pop(meta["index"], None)
+    return done
+
+def track(dfss, failed, journal=None):
+    # pass the processed files on, setting aside the ones that could not be read,
+    # and log every file to the journal as soon as it's done
+    for meta, dfs in dfss:
+        if journal is not None:
+            journal.write(json.dumps({"meta": meta, "shard": dfs}) + "\n")
+            journal.flush()
+            os.fsync(journal.fileno())
+        if dfs is None:
+            failed.append(meta)
+            continue
+        yield meta, dfs
+
+def report_failed(output, failed):
+    failedpath = pathlib.Path(str(output) + ".failed")
+    if len(failed) == 0:
+        if failedpath.exists():
+            failedpath.unlink()
+        return
+    print(f"{len(failed)} input files could not be processed:")
+    for meta in sorted(failed, key=lambda m: m["index"]):
+        print(f"  {meta['url']}: {meta.get('error', '')}")
+    with open(failedpath, "w") as f:
+        f.writelines(meta["url"] + "\n" for meta in failed)
+    print(f"The list is in {failedpath}.")
+
+def read_inputs(output):
+    # the input table of an existing output, for -incremental
+    with open_store(output, mode="r", format=args.Format) as store:
+        if INPUTS_KEY not in store:
+            print(f"{output} has no table of its input files (written before -incremental existed?). Rerun without -incremental.")
+            sys.exit(1)
+    return read_df(output, INPUTS_KEY)
+
+def input_uuid(url):
+    # UUID of the ROOT file at url now, "" if it can't be opened
+    try:
+        with uproot.open(_xrootd_url(url), timeout=120) as f:
+            return str(f.file.uuid)
+    except (OSError, ValueError) as e:
+        print(f"Could not open {url} to check it against the output ({e}).")
+        return ""
+
+def replaced_inputs(done, inputs):
+    # the inputs already in the output whose file has a different UUID now
+    uuids = dict(zip(done.url, done.uuid))
+    known = [url for url in inputs if uuids.get(url, "") != ""]
+    with ThreadPoolExecutor(max_workers=16) as ex:
+        now = list(ex.map(input_uuid, known))
+    unchecked = sum(uuid == "" for uuid in now)
+    if unchecked:
+        print(f"{unchecked} of the input files in the output could not be rechecked, their frames are kept as they are.")
+    return [url for url, uuid in zip(known, now) if uuid != "" and uuid != uuids[url]]
+
+def drop_inputs(output, done, urls):
+    # remove the rows of the input files urls from the splits they went into, and
+    # from the input table (returned)
+    stale = done[done.url.isin(urls)]
+    ntuples = set(stale["__ntuple"])
+    splits = set(stale["split"])
+    with open_store(output, format=args.Format, compression=args.Compression) as store:
+        for key in store.keys():
+            m = re.search(r"_(\d+)$", key)
+            if m is None or int(m.group(1)) not in splits:
+                continue
+            df = store.get(key)
+            keep = ~df.index.get_level_values("__ntuple").isin(ntuples)
+            if not keep.all():
+                store.put(key, df[keep], format="fixed")
+    return done[~done.url.isin(urls)]
+
 def run_pool(output, inputs, nproc):
     os.nice(10)
+    output = pathlib.Path(output).with_suffix('.pqdf' if args.Format == "parquet" else '.df')
+
+    # -incremental: skip the inputs already in the output, and continue its __ntuple and split numbering
+    done = pd.DataFrame(columns=INPUTS_COLUMNS)
+    if args.Incremental and output.exists():
+        done = read_inputs(output)
+        # -recheck: a file replaced at the same URL since is processed again
+        replaced = replaced_inputs(done, inputs) if args.Recheck else []
+        if replaced:
+            print(f"{len(replaced)} input files changed since they were added to {output}, processing them again.")
+            done = drop_inputs(output, done, replaced)
+        urls = set(done.url)
+        inputs = [url for url in inputs if url not in urls]
+        if len(inputs) == 0:
+            print(f"No new input files for {output}.")
+            return
+        print(f"Adding {len(inputs)} new input files to {output} ({len(done)} already there).")
+    first_index = int(done["__ntuple"].max()) + 1 if len(done) else 0
+    k_idx = int(done["split"].max()) + 1 if len(done) else 0
+
     ntuples = NTupleGlob(inputs, None)
 
     # if PREPROCESS doesn't exist, set it to None
@@ -52,73 +250,74 @@ def run_pool(output, inputs, nproc):
     except:
         PREPROCESS = []
 
-    dfss = ntuples.dataframes(nproc=nproc, fs=DFS, preprocess=PREPROCESS)
-    output = pathlib.Path(output).with_suffix('.df')
-    k_idx = 0
-    split_margin = args.SplitSize
-    with pd.HDFStore(output) as hdf_pd:
+    sharddir = None
+    journal = None
+    resumed = {}
+    if args.Resume:
+        # the shards and the journal stay next to the output until it's written
+        sharddir = os.path.abspath(str(output) + ".shards")
+        os.makedirs(sharddir, exist_ok=True)
+        journalpath = str(output) + ".journal"
+        resumed = read_journal(journalpath, inputs, first_index)
+        if resumed:
+            print(f"Resuming: {len(resumed)} of {len(inputs)} input files already done.")
+        journal = open(journalpath, "a")
+    elif args.ShardDir != "":
+        os.makedirs(args.ShardDir, exist_ok=True)
+        sharddir = tempfile.mkdtemp(prefix="cafpyana_shards_", dir=args.ShardDir)
+
+    # compact_dtypes only touches the weight, id and hit flag columns, so every frame can go through it
+    compact = None
+    if args.Compact:
+        compact = [True] * len(NAMES)
+
+    cache = None
+    if args.CacheDir != "":
+        if PREPROCESS:
+            print("PREPROCESS steps are set, not using the maker cache.")
+        else:
+            cache = MakerCache(args.CacheDir, args.CacheSize * 1024**3)
+
+    prefetch = None
+    if args.Prefetch > 0:
+        prefetch = Prefetcher(args.PrefetchDir if args.PrefetchDir != "" else None, nahead=args.Prefetch, maxbytes=args.PrefetchSize * 1024**3)
+
+    # frames arrive file-by-file as the workers finish, and are only held until
+    # the current split reaches SplitSize
+    dfss = ntuples.iterdataframes(nproc=nproc, fs=DFS, preprocess=PREPROCESS, sharddir=sharddir, compact=compact, cache=cache, savemeta=True, first_index=first_index, skip=set(resumed), prefetch=prefetch)
+    failed = []
+    dfss = track(dfss, failed, journal)
+    if sharddir is not None:
+        shards = list(dfss) + list(resumed.values())
+        if journal is not None:
+            journal.close()
+            if len(shards) + len(failed) < len(inputs):
+                print(f"Stopped after {len(shards) + len(failed)} of {len(inputs)} input files. Rerun with -resume to continue.")
+                return
+        dfss = iter_shards(shards)
+
+    with open_store(output, format=args.Format, compression=args.Compression) as hdf_pd:
         NAMES.append("histpotdf")
         NAMES.append("histgenevtdf")
-        size_counters = {k: 0 for k in NAMES}
-        df_buffers = {k: [] for k in NAMES}
-
-        for dfs in dfss:
-            this_NAMES = NAMES
-            if len(dfs) == 2: ## no or empty recTree
-                this_NAMES = ["histpotdf", "histgenevtdf"]
-
-            for k, df in zip(reversed(this_NAMES), reversed(dfs)):
-                this_key = k + "_" + str(k_idx)
-                size_bytes = df.memory_usage(deep=True).sum() if df is not None else 0
-                size_gb = size_bytes / (1024**3)
-                if len(dfs) == 2: ## no or empty recTree
-                    size_counters["histpotdf"] += size_gb
-                    df_buffers["histpotdf"].append(df)
-
-                    size_counters["histgenevtdf"] += size_gb
-                    df_buffers["histgenevtdf"].append(df)
-                else:
-                    size_counters[k] += size_gb
-                    if df is not None:
-                        df_buffers[k].append(df)  # accumulate
-
-                #print(f"{k}_{k_idx}: added {size_gb:.4f} GB (total {size_counters[k]:.4f} GB)")
-
-                del df
-
-            if any(val > split_margin for val in size_counters.values()):
-                # Concatenate and save accumulated DataFrames
-                for k, buffer in df_buffers.items():
-                    if buffer:  # only if buffer has data
-                        concat_df = pd.concat(buffer, ignore_index=False)
-                        this_key = k + "_" + str(k_idx)
-                        try:
-                            hdf_pd.put(key=this_key, value=concat_df, format="fixed")
-                            print(f"Saved {this_key}: {concat_df.memory_usage(deep=True).sum() / (1024**3):.4f} GB")
-                        except Exception as e:
-                            print(f"Table {this_key} failed to save, skipping. Exception: {str(e)}")
-                        del concat_df
-                # Reset counters and buffers
-                k_idx += 1
-                size_counters = {k: 0 for k in this_NAMES}
-                df_buffers = {k: [] for k in this_NAMES}
-
-        for k, buffer in df_buffers.items():
-            if buffer:
-                concat_df = pd.concat(buffer, ignore_index=False)
-                this_key = k + "_" + str(k_idx)
-                try:
-                    hdf_pd.put(key=this_key, value=concat_df, format="fixed")
-                    print(f"Saved {this_key}: {concat_df.memory_usage(deep=True).sum() / (1024**3):.4f} GB")
-                except Exception as e:
-                    print(f"Table {this_key} failed to save, skipping. Exception: {str(e)}")
-                del concat_df
+        n_split, written = write_dfs(hdf_pd, dfss, NAMES, k_idx=k_idx)
+
+        # Save the input files, so that a later -incremental run knows what is in here
+        inputs_df = pd.concat([done, pd.DataFrame(written, columns=INPUTS_COLUMNS)], ignore_index=True)
+        inputs_df = inputs_df.astype({"url": str, "uuid": str, "__ntuple": "int64", "split": "int64"})
+        hdf_pd.put(key=INPUTS_KEY, value=inputs_df, format="fixed")
 
         # Save the split count metadata
-        split_df = pd.DataFrame({"n_split": [k_idx + 1]})  # +1 because k_idx is 0-based
+        split_df = pd.DataFrame({"n_split": [max(n_split, 1)]})
         hdf_pd.put(key="split", value=split_df, format="fixed")
         print(f"Saved split info: {split_df.iloc[0]['n_split']} total splits")
 
+    report_failed(output, failed)
+
+    if sharddir is not None:
+        shutil.rmtree(sharddir)
+    if journal is not None:
+        os.remove(journal.name)
+
 def run_grid(inputfiles):
     # 1) dir/file name style
     JobStartTime = datetime.datetime.now()
@@ -6,7 +6,11 @@ import argparse
 from pyanalib.ntuple_glob import NTupleGlob
 from pyanalib.split_df_helpers import *
 import pandas as pd
+import numpy as np
+import awkward as ak
+import uproot
 from tqdm.auto import tqdm
+from multiprocessing import Pool
 import warnings
 
 warnings.simplefilter(action='ignore', category=pd.errors.PerformanceWarning)
@@ -27,43 +31,98 @@ parser.add_argument('-o', dest='output', default="", help="output data frame nam
 parser.add_argument('-i', dest='inputfiles', default="", help="input root file path, you can submit multiple files using comma, i.e.) -i input_0.root,input_1.root")
 parser.add_argument('-l', dest='inputfilelist', default="", help="a file of list for input root files")
 parser.add_argument('-nfile', dest='NFiles', default=0, type=int, help="Number of files to run. Default = 0, run all input files.")
+parser.add_argument('-ncpu', dest='NCPU', default=1, type=int, help="Number of processes running TTREEMKR on the splits. The trees are still written\nin input/split order by this process. Default = 1, run serially.")
+parser.add_argument('-batch', dest='BatchSize', default=100000, type=int, help="Number of rows collected from consecutive splits before they are written out as one basket.\nDefault = 100000.")
 args = parser.parse_args()
 
-def run(output, inputs):
-    first_fill = True
-
-    # count total splits beforehand for nice tqdm bar
-    total_splits = sum(get_n_split(inp) for inp in inputs)
-
-    with uproot.recreate(output) as f, tqdm(total=total_splits, desc="Processing splits") as pbar:
-        for input in inputs:
-            this_n_split = get_n_split(input)
-            for split in range(this_n_split):
-                result = TTREEMKR(input, split)
-                if isinstance(result, tuple) and len(result) == 2 \
-                   and isinstance(result[0], pd.DataFrame) and isinstance(result[1], pd.DataFrame):
-                    recodf, truedf = result
-                elif isinstance(result, pd.DataFrame):
-                    recodf, truedf = result, pd.DataFrame()
-                else:
-                    raise TypeError(
-                        "TTREEMKR must return either a (recodf, truedf) tuple of DataFrames "
-                        "or a single reco DataFrame."
-                    )
-
-                write_true = truedf is not None and not truedf.empty
-                if first_fill:
-                    f["SelectedEvents"] = recodf.to_dict(orient="list")
-                    if write_true:
-                        f["TrueEvents"] = truedf.to_dict(orient="list")
-                    first_fill = False
-                else:
-                    f["SelectedEvents"].extend(recodf.to_dict(orient="list"))
-                    if write_true:
-                        f["TrueEvents"].extend(truedf.to_dict(orient="list"))
-
-                # update progress bar
-                pbar.update(1)
+def branch_array(s):
+    # keep the branch types the old list-based writer produced (bool, int64, float64)
+    v = s.to_numpy()
+    if v.dtype.kind == "b":
+        return v
+    if v.dtype.kind in "iu":
+        return v.astype(np.int64)
+    if v.dtype.kind == "f":
+        return v.astype(np.float64)
+    # per-row lists and other python objects
+    return ak.from_iter(s.tolist())
+
+def tree_arrays(df):
+    # DataFrame -> {branch: array} for uproot. Plain columns become flat branches. A
+    # level-0 column group with named sub-columns, e.g. a systematic's (syst, "univ_<i>")
+    # weights, becomes one fixed-size double[n] branch, as PROfit/MakesBruce.C expects.
+    names = df.columns.get_level_values(0)
+    groups = {}
+    for i, n in enumerate(names):
+        groups.setdefault(n, []).append(i)
+
+    arrays = {}
+    for n, pos in groups.items():
+        col = df.columns[pos[0]]
+        if len(pos) == 1 and (df.columns.nlevels == 1 or all(l == "" for l in col[1:])):
+            arrays[str(n)] = branch_array(df.iloc[:, pos[0]])
+        else:
+            arrays[str(n)] = df.iloc[:, pos].to_numpy(dtype=np.float64)
+    return arrays
+
+def split_frames(result):
+    if isinstance(result, tuple) and len(result) == 2 \
+       and isinstance(result[0], pd.DataFrame) and isinstance(result[1], pd.DataFrame):
+        return result
+    elif isinstance(result, pd.DataFrame):
+        return result, pd.DataFrame()
+    raise TypeError(
+        "TTREEMKR must return either a (recodf, truedf) tuple of DataFrames "
+        "or a single reco DataFrame."
+    )
+
+def write_tree(f, name, dfs):
+    # one extend for all the buffered splits
+    if len(dfs) == 0:
+        return
+    arrays = tree_arrays(pd.concat(dfs, ignore_index=True) if len(dfs) > 1 else dfs[0])
+    if name in f:
+        f[name].extend(arrays)
+    else:
+        f[name] = arrays
+
+def make_split(job):
+    # runs in the pool workers, which get TTREEMKR from the config through fork
+    input, split = job
+    return split_frames(TTREEMKR(input, split))
+
+def iter_splits_made(jobs, nproc):
+    # splits are independent; imap hands the results back in job order, so the
+    # trees come out the same as in a serial run
+    if nproc <= 1:
+        for job in jobs:
+            yield make_split(job)
+        return
+    with Pool(processes=nproc) as pool:
+        for result in pool.imap(make_split, jobs):
+            yield result
+
+def run(output, inputs, nproc=1):
+    jobs = [(inp, split) for inp in inputs for split in range(get_n_split(inp))]
+
+    buffers = {"SelectedEvents": [], "TrueEvents": []}
+    def flush(f):
+        for name, dfs in buffers.items():
+            write_tree(f, name, dfs)
+            dfs.clear()
+
+    with uproot.recreate(output) as f, tqdm(total=len(jobs), desc="Processing splits") as pbar:
+        for recodf, truedf in iter_splits_made(jobs, nproc):
+            buffers["SelectedEvents"].append(recodf)
+            if truedf is not None and not truedf.empty:
+                buffers["TrueEvents"].append(truedf)
+            if any(sum(len(df) for df in dfs) >= args.BatchSize for dfs in buffers.values()):
+                flush(f)
+
+            # update progress bar
+            pbar.update(1)
+
+        flush(f)
 
 if __name__ == "__main__":
     printhelp = ((args.inputfiles == "" and args.inputfilelist == "") or args.config == "" or args.output == "")
@@ -94,4 +153,4 @@ if __name__ == "__main__":
             InputSamples = InputSamples[:args.NFiles]
         
         exec(open(args.config).read())
-        run(args.output, InputSamples)
+        run(args.output, InputSamples, args.NCPU)
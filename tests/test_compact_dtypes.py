@@ -0,0 +1,43 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from pyanalib.pandas_helpers import compact_dtypes
+
+def split(seed, scale):
+    # a hit frame and a weight frame like the makers write, with value ranges set by scale
+    rng = np.random.default_rng(seed)
+    n = 20
+    hits = pd.DataFrame({
+        "dedx": rng.random(n) * scale,
+        "t": rng.random(n) * 1e6 * scale,
+        "plane": rng.integers(0, 3, n),
+        "cryo": rng.integers(0, 2, n),
+        "run": rng.integers(0, 100 * scale, n),
+        "firsthit": np.arange(n) == 0,
+        "lasthit": (np.arange(n) == n - 1).astype(int),
+    })
+    cols = pd.MultiIndex.from_tuples([("GENIE", "univ_%i" % i, "") for i in range(3)] + [("flux", "cv", ""), ("nu", "E", "")])
+    wgts = pd.DataFrame(rng.random((n, 5)) * scale, columns=cols)
+    return hits, wgts
+
+def test_same_dtypes_for_every_split():
+    small = [compact_dtypes(df) for df in split(0, 1)]
+    large = [compact_dtypes(df) for df in split(1, 100000)]
+    for a, b in zip(small, large):
+        pd.testing.assert_series_equal(a.dtypes, b.dtypes)
+
+def test_profile():
+    hits, wgts = [compact_dtypes(df) for df in split(0, 1)]
+    assert hits.plane.dtype == np.uint8 and hits.cryo.dtype == np.uint8
+    assert hits.firsthit.dtype == bool and hits.lasthit.dtype == bool
+    # columns outside of the profile keep their dtype
+    assert hits.dedx.dtype == np.float64 and hits.t.dtype == np.float64 and hits.run.dtype == np.int64
+    assert (wgts.GENIE.dtypes == np.float32).all() and wgts.flux.cv.dtype == np.float32
+    assert wgts.nu.E.dtype == np.float64
+
+def test_out_of_range():
+    hits, _ = split(0, 1)
+    hits.loc[0, "plane"] = -1
+    with pytest.raises(ValueError):
+        compact_dtypes(hits)
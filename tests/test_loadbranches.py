@@ -0,0 +1,77 @@
+import awkward as ak
+import numpy as np
+import pandas as pd
+
+from pyanalib import pandas_helpers as ph
+
+class FakeTree(object):
+    """Just enough of an uproot TTree for loadbranches: keys() and arrays()."""
+    def __init__(self, branches):
+        self.branches = branches
+
+    def keys(self):
+        return list(self.branches)
+
+    def __contains__(self, name):
+        return name in self.branches
+
+    def arrays(self, branches, library="ak"):
+        return ak.Array({b: self.branches[b] for b in branches})
+
+def loadbranches_merge(tree, branches):
+    # the old implementation: build the index with one pandas merge per vector level
+    return ph._caf_columns(ph._mergevectors(tree, branches, ph._branch_vectors(tree, branches)), branches)
+
+def make_tree(seed=0, nentry=40):
+    # rec.slc -> rec.slc.pfp -> rec.slc.pfp.hit, with empty entries and empty vectors at every level
+    rng = np.random.default_rng(seed)
+    nslc = rng.integers(0, 3, nentry)
+    nslc[:3] = 0
+    npfp = [rng.integers(0, 4, n) for n in nslc]
+    nhit = [rng.integers(0, 3, p.sum()) for p in npfp]
+    return FakeTree({
+        "rec.hdr.run": np.arange(nentry, dtype=np.int32),
+        "rec.slc..length": nslc.astype(np.int32),
+        "rec.slc.nu_score": [rng.random(n).astype(np.float32) for n in nslc],
+        "rec.slc.pfp..length": [p.astype(np.int32) for p in npfp],
+        "rec.slc.pfp.len": [rng.random(p.sum()) for p in npfp],
+        "rec.slc.pfp.trackScore": [rng.random(p.sum()) for p in npfp],
+        "rec.slc.pfp.hit..length": [h.astype(np.int32) for h in nhit],
+        "rec.slc.pfp.hit.dedx": [rng.random(h.sum()).astype(np.float32) for h in nhit],
+        "rec.slc.pfp.hit.plane": [rng.integers(0, 3, h.sum()).astype(np.int16) for h in nhit],
+    })
+
+def check(tree, branches):
+    new = ph.loadbranches(tree, branches)
+    old = loadbranches_merge(tree, branches)
+    assert new.index.equals(old.index)
+    assert list(new.index.names) == list(old.index.names)
+    pd.testing.assert_frame_equal(new, old, check_index_type=False)
+    return new
+
+def test_scalar():
+    df = check(make_tree(), ["rec.hdr.run"])
+    assert len(df) == 40
+
+def test_one_level():
+    df = check(make_tree(), ["rec.slc.nu_score"])
+    assert df.index.names == ["entry", "rec.slc..index"]
+
+def test_two_levels():
+    check(make_tree(), ["rec.slc.pfp.len", "rec.slc.pfp.trackScore"])
+
+def test_three_levels():
+    for seed in range(3):
+        df = check(make_tree(seed), ["rec.slc.pfp.hit.dedx", "rec.slc.pfp.hit.plane"])
+        assert df.index.nlevels == 4
+
+def test_empty_vectors():
+    # zero-length hit vectors everywhere in entry 5, empty slice vectors in the first entries
+    tree = make_tree(3)
+    nhit = tree.branches["rec.slc.pfp.hit..length"]
+    assert any(len(h) == 0 for h in nhit) and any((h == 0).any() for h in nhit)
+    nhit[5] = np.zeros_like(nhit[5])
+    tree.branches["rec.slc.pfp.hit.dedx"][5] = np.zeros(0, dtype=np.float32)
+    tree.branches["rec.slc.pfp.hit.plane"][5] = np.zeros(0, dtype=np.int16)
+    df = check(tree, ["rec.slc.pfp.hit.dedx", "rec.slc.pfp.hit.plane"])
+    assert 5 not in df.index.get_level_values("entry")
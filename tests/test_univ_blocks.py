@@ -0,0 +1,44 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from pyanalib.pandas_helpers import multicol_concat
+from pyanalib.split_df_helpers import ParquetStore, read_df, read_univ_blocks
+
+def mcnudf(n=30, nuniv=5):
+    # built the way make_mcnudf does: the weight frame concatenated to deeper mc columns
+    rng = np.random.default_rng(0)
+    index = pd.MultiIndex.from_arrays([np.repeat(np.arange(n // 2), 2), np.tile([0, 1], n // 2)], names=["entry", "rec.mc.nu..index"])
+    mc = pd.DataFrame(rng.random((n, 3)), index=index,
+                      columns=pd.MultiIndex.from_tuples([("E", "", ""), ("position", "x", ""), ("prim", "mu", "genE")]))
+    wgtcols = [("GENIE_a", "univ_%i" % i) for i in range(nuniv)] + [("GENIE_b", "ps1"), ("GENIE_b", "ms1"), ("GENIE_b", "cv")] + \
+        [("Flux", "univ_%i" % i) for i in range(nuniv)]
+    wgt = pd.DataFrame(rng.random((n, len(wgtcols))).astype(np.float32), index=index, columns=pd.MultiIndex.from_tuples(wgtcols))
+    return multicol_concat(mc, wgt)
+
+def test_padded_weights_round_trip(tmp_path):
+    df = mcnudf()
+    assert df.columns[3] == ("GENIE_a", "univ_0", "")
+
+    pq = str(tmp_path / "out.pqdf")
+    os.makedirs(pq)
+    ParquetStore(pq).put("mcnu_0", df)
+    h5 = str(tmp_path / "out.df")
+    df.to_hdf(h5, key="mcnu_0", format="fixed")
+
+    # the universe runs are stored as blocks and come back as the same columns
+    _, _, packed, _ = ParquetStore(pq)._meta("mcnu_0")
+    assert packed == {"GENIE_a|univ_*|": 5, "Flux|univ_*|": 5}
+    schema_names = ParquetStore(pq).columns("mcnu_0")
+    assert list(schema_names) == list(df.columns)
+    pd.testing.assert_frame_equal(read_df(pq, "mcnu_0"), df)
+    sub = read_df(pq, "mcnu_0", columns=[("GENIE_b",), ("Flux",)])
+    pd.testing.assert_frame_equal(sub, df[[c for c in df.columns if c[0] in ("GENIE_b", "Flux")]])
+
+    pq_index, pq_blocks = read_univ_blocks(pq, "mcnu_0")
+    h5_index, h5_blocks = read_univ_blocks(h5, "mcnu_0")
+    assert pq_index.equals(h5_index)
+    assert sorted(pq_blocks) == sorted(h5_blocks) == ["Flux", "GENIE_a"]
+    for s in h5_blocks:
+        np.testing.assert_array_equal(pq_blocks[s], h5_blocks[s])